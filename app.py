@@ -1,119 +1,283 @@
-from flask import Flask, send_from_directory, jsonify, send_file, Response
+import time
+
+# Boot timing, reported by /health/ready
+BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, g, jsonify, Response, request
+import json
+import math
 import os
 import sys
 
+from werkzeug.security import safe_join
+
+from corpus import CORPUS_FILENAME
+from cors import (DEFAULT_RULES as DEFAULT_CORS, CorsPolicy,
+                  parse_rules as parse_cors)
+from health import Readiness
+from levels import CHAR_LEVELS, IDIOM_LEVELS, LiveRegistry
+from logs import configure_logging, log_access
+from media import asset_mimetype, send_asset
+from metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, METRICS, phase,
+                     record_request, start_timer, stop_timer)
+from payloads import (CACHE_REVALIDATE, Payload, content_hash,
+                      negotiate)
+from ratelimit import RateLimiter, make_backend, parse_rules
+from static_files import FINGERPRINTED, FINGERPRINT_LENGTH, StaticFiles
+
+IMPORTS_DONE = time.perf_counter()
+
+# Logs are JSON lines on stderr, written by a background thread
+configure_logging()
+
 # Get the directory where this file is located
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-app = Flask(__name__, 
-            static_folder=os.path.join(BASE_DIR, 'static'),
-            static_url_path='',
+# Cold-start mode, for serverless hosts where an instance lives for a
+# handful of requests: on automatically on Vercel, or with
+# CCB_COLD_START=1. Level data is then read at import, in one read of
+# the compiled corpus, so the first request does not pay for it.
+COLD_START = bool(os.environ.get('VERCEL')) or (
+    os.environ.get('CCB_COLD_START', '') not in ('', '0'))
+
+# Level data is loaded once per process and then served from memory.
+# The compiled corpus (see `python app.py compile-levels`) is
+# memory-mapped on first use; without it, level source files are parsed.
+CORPUS_PATH = os.path.join(BASE_DIR, CORPUS_FILENAME)
+level_registry = LiveRegistry(BASE_DIR, corpus_path=CORPUS_PATH,
+                              mapped=not COLD_START)
+if COLD_START:
+    level_registry.load()
+
+# Level files are polled every CCB_RELOAD_INTERVAL seconds (default 2;
+# 0 turns it off, as does cold-start mode, where instances are short
+# lived) and edits are picked up without a restart
+RELOAD_INTERVAL = float(os.environ.get('CCB_RELOAD_INTERVAL',
+                                       '0' if COLD_START else '2'))
+if RELOAD_INTERVAL > 0:
+    level_registry.watch(RELOAD_INTERVAL)
+
+# Servable files are indexed at startup: static/ plus the level JSON
+# files at the top level. Small files are kept in memory with their gzip
+# variants. The index is rescanned every CCB_RELOAD_INTERVAL seconds too,
+# so edited, added and removed files are served without a restart. In
+# cold-start mode files are only stat'ed, and read on first request.
+static_files = StaticFiles(os.path.join(BASE_DIR, 'static'),
+                           extra_directory=BASE_DIR, extra_types=['.json'],
+                           lazy=COLD_START)
+if RELOAD_INTERVAL > 0:
+    static_files.watch(RELOAD_INTERVAL)
+
+# Static files go through serve_static_files and its file table rather
+# than Flask's static route
+app = Flask(__name__,
+            static_folder=None,
             root_path=BASE_DIR)
 
-# Add CORS headers for API requests
+# Which origins may read which routes (CCB_CORS, see cors.py); used by
+# this app and by the ASGI app in asgi.py
+cors_policy = CorsPolicy(parse_cors(os.environ.get('CCB_CORS', DEFAULT_CORS)))
+
+# Set CCB_SERVER_TIMING=1 to time the phases of each request (lookup,
+# load, parse, serialize, send), report them in a Server-Timing header
+# and keep per-route phase histograms at /metrics
+SERVER_TIMING = os.environ.get('CCB_SERVER_TIMING', '') not in ('', '0')
+
+# Rate limits per client address and route class, e.g.
+# CCB_RATE_LIMIT="api=20:100,static=10:50" (see ratelimit.py); off when
+# unset. Behind reverse proxies, CCB_PROXY_HOPS is the number of proxies
+# that append to X-Forwarded-For, and the client address is read from it.
+rate_limiter = RateLimiter(
+    parse_rules(os.environ.get('CCB_RATE_LIMIT', '')),
+    make_backend(os.environ.get('CCB_RATE_LIMIT_BACKEND')))
+PROXY_HOPS = int(os.environ.get('CCB_PROXY_HOPS', '0'))
+
+def route_class(path):
+    """Return the rate limit class of a path, or None if it is exempt."""
+    if path.startswith('/api/'):
+        return 'api'
+    if path.startswith('/assets/'):
+        return 'assets'
+    if path.startswith('/health') or path == '/metrics':
+        return None
+    return 'static'
+
+def client_address(remote_addr, forwarded_for=None):
+    """Return the client address, as seen by the outermost trusted proxy."""
+    if PROXY_HOPS and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        return hops[-min(PROXY_HOPS, len(hops))]
+    return remote_addr
+
+def rate_limit(path, remote_addr, forwarded_for=None):
+    """Return None, or (status, headers, body) of a 429 response."""
+    if not rate_limiter.rules:
+        return None
+    wait = rate_limiter.check(client_address(remote_addr, forwarded_for),
+                              route_class(path))
+    if wait is None:
+        return None
+    return 429, [('Content-Type', 'application/json'),
+                 ('Cache-Control', 'no-store'),
+                 ('Retry-After', str(max(1, math.ceil(wait))))], \
+        b'{"error":"too many requests"}'
+
+@app.before_request
+def before_request():
+    g.started = time.perf_counter()
+    if SERVER_TIMING:
+        start_timer()
+    # OPTIONS (CORS preflights included) never reaches a view
+    if request.method == 'OPTIONS':
+        status, headers, body = cors_policy.options(
+            request.path, request.headers.get('Origin'),
+            request.headers.get('Access-Control-Request-Method'))
+        response = Response(body, status=status, headers=headers)
+        # An empty 204 has no content type
+        del response.headers['Content-Type']
+        return response
+    refused = rate_limit(request.path, request.remote_addr,
+                         request.headers.get('X-Forwarded-For'))
+    if refused is not None:
+        status, headers, body = refused
+        return Response(body, status=status, headers=headers)
+
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 
-                        'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 
-                        'GET,PUT,POST,DELETE,OPTIONS')
+    for name, value in cors_policy.headers(request.path,
+                                           request.headers.get('Origin')):
+        if name == 'Vary':
+            response.vary.add(value)
+        else:
+            response.headers[name] = value
+    timer = stop_timer() if SERVER_TIMING else None
+    if timer is not None:
+        response.headers['Server-Timing'] = timer.server_timing()
+    started = g.get('started')
+    if started is not None:
+        rule = request.url_rule
+        route = rule.rule if rule is not None else 'unmatched'
+        elapsed = time.perf_counter() - started
+        record_request(route, request.method, response.status_code,
+                       elapsed, response.content_length, timer)
+        log_access(route, request.method, request.path,
+                   response.status_code, elapsed, response.content_length)
     return response
 
+def payload_response(payload, immutable=None):
+    """Build a conditional response for a pre-encoded payload.
+
+    See payloads.negotiate; immutable=True marks a URL whose path names
+    the payload's version.
+    """
+    with phase('send'):
+        status, headers, body = negotiate(
+            payload,
+            accept_encoding=request.headers.get('Accept-Encoding'),
+            if_none_match=request.headers.get('If-None-Match'),
+            if_modified_since=request.headers.get('If-Modified-Since'),
+            version=request.args.get('v'),
+            immutable=immutable)
+        return Response(body, status=status, headers=headers)
+
 # Serve the main HTML file
+# Errors are logged (with tracebacks, for exceptions, by Flask) and never
+# described in the response; /health/ready with CCB_DEBUG=1 lists paths
 @app.route('/')
 def index():
-    try:
-        static_dir = os.path.join(BASE_DIR, 'static')
-        index_path = os.path.join(static_dir, 'index.html')
-        if not os.path.exists(index_path):
-            return jsonify({
-                'error': 'index.html not found',
-                'path': index_path,
-                'base_dir': BASE_DIR,
-                'cwd': os.getcwd(),
-                'static_dir': static_dir,
-                'files': os.listdir(BASE_DIR) if os.path.exists(BASE_DIR) else []
-            }), 500
-        return send_from_directory(static_dir, 'index.html', 
-                                  mimetype='text/html')
-    except Exception as e:
-        import traceback
-        return jsonify({
-            'error': str(e),
-            'traceback': traceback.format_exc(),
-            'base_dir': BASE_DIR,
-            'cwd': os.getcwd()
-        }), 500
+    payload = static_files.page('index.html')
+    if payload is None:
+        app.logger.error('index.html not found',
+                         extra={'static_dir': static_files.directory})
+        return jsonify({'error': 'index.html not found'}), 500
+    return payload_response(payload)
+
+# Serve fingerprinted JavaScript and CSS (game.<hash>.js), which never
+# change and are cached for a year
+@app.route('/<name>.<digest>.<any(js, css):ext>')
+def serve_fingerprinted(name, digest, ext):
+    filename = f'{name}.{ext}'
+    if filename not in FINGERPRINTED:
+        return serve_static_files(f'{name}.{digest}.{ext}')
+    payload = static_files.get(filename)
+    if payload is None:
+        return 'Not found', 404
+    # An outdated hash still gets the current file, just not as immutable
+    return payload_response(
+        payload, immutable=digest == payload.version[:FINGERPRINT_LENGTH])
 
 # Serve static JavaScript and CSS files
 @app.route('/game.js')
 def serve_game_js():
-    try:
-        return send_from_directory(
-            os.path.join(BASE_DIR, 'static'), 
-            'game.js', 
-            mimetype='application/javascript'
-        )
-    except Exception as e:
-        return jsonify({'error': str(e), 'base_dir': BASE_DIR}), 500
+    payload = static_files.get('game.js')
+    if payload is None:
+        return 'Not found', 404
+    return payload_response(payload)
 
 @app.route('/style.css')
 def serve_style_css():
-    try:
-        return send_from_directory(
-            os.path.join(BASE_DIR, 'static'), 
-            'style.css', 
-            mimetype='text/css'
-        )
-    except Exception as e:
-        return jsonify({'error': str(e), 'base_dir': BASE_DIR}), 500
+    payload = static_files.get('style.css')
+    if payload is None:
+        return 'Not found', 404
+    return payload_response(payload)
+
+# URLs the service worker precaches besides the fingerprinted shell
+# files and versioned level data; it serves /api/manifest network-first
+# and uses the cached copy only offline
+SHELL_URLS = ['/', '/api/manifest']
+
+_service_worker = {}
+
+def service_worker_payload():
+    """Return sw.js prefixed with the precache list for current content.
+
+    The list is versioned by the level manifest and the shell files, so
+    any content change alters the script and browsers install the new
+    worker in the background.
+    """
+    script = static_files.get('sw.js')
+    if script is None:
+        return None
+    manifest_payload = level_registry.manifest()
+    page = static_files.page('index.html')
+    assets = [static_files.fingerprinted(name) for name in FINGERPRINTED]
+    key = ' '.join([script.version, manifest_payload.version] +
+                   ([page.version] if page is not None else []) +
+                   [name for name in assets if name is not None])
+    if _service_worker.get('key') != key:
+        manifest = json.loads(bytes(manifest_payload.body))
+        urls = SHELL_URLS + [f'/{name}' for name in assets if name] + [
+            f'{info["url"]}?v={info["hash"]}'
+            for info in (manifest['bundle'], manifest['syllables'])]
+        precache = json.dumps({'version': content_hash(key.encode('ascii')),
+                               'urls': urls})
+        _service_worker['payload'] = Payload(
+            f'self.PRECACHE = {precache};\n'.encode('utf-8') + script.body,
+            'application/javascript')
+        _service_worker['key'] = key
+    return _service_worker['payload']
+
+# Serve the service worker from the root so it controls the whole site
+@app.route('/sw.js')
+def serve_service_worker():
+    payload = service_worker_payload()
+    if payload is None:
+        return 'Not found', 404
+    response = payload_response(payload)
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
 
 # Serve assets files (videos, audio, etc.)
 @app.route('/assets/<path:filename>')
 def serve_assets(filename):
-    try:
-        assets_path = os.path.join(BASE_DIR, 'assets', filename)
-        if not os.path.exists(assets_path):
-            return jsonify({
-                'error': 'File not found',
-                'requested': filename,
-                'assets_path': assets_path,
-                'base_dir': BASE_DIR,
-                'assets_dir_exists': os.path.exists(os.path.join(BASE_DIR, 'assets')),
-                'files_in_assets': os.listdir(os.path.join(BASE_DIR, 'assets')) if os.path.exists(os.path.join(BASE_DIR, 'assets')) else []
-            }), 404
-        
-        # Determine MIME type based on extension
-        ext = os.path.splitext(filename)[1].lower()
-        mime_types = {
-            '.mp4': 'video/mp4',
-            '.wav': 'audio/wav',
-            '.mp3': 'audio/mpeg',
-            '.png': 'image/png',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.gif': 'image/gif',
-            '.svg': 'image/svg+xml',
-            '.ttf': 'font/ttf',
-            '.woff': 'font/woff',
-            '.woff2': 'font/woff2'
-        }
-        mimetype = mime_types.get(ext, 'application/octet-stream')
-        
-        return send_from_directory(
-            os.path.join(BASE_DIR, 'assets'), 
-            filename, 
-            mimetype=mimetype
-        )
-    except Exception as e:
-        import traceback
-        return jsonify({
-            'error': str(e),
-            'traceback': traceback.format_exc(),
-            'filename': filename,
-            'base_dir': BASE_DIR
-        }), 500
+    path = safe_join(os.path.join(BASE_DIR, 'assets'), filename)
+    with phase('send'):
+        response = path and send_asset(request, path,
+                                       asset_mimetype(filename))
+    if response is None:
+        return 'Not found', 404
+    response.headers['Cache-Control'] = CACHE_REVALIDATE
+    return response
 
 # Serve static files (JS, CSS, etc.)
 @app.route('/<path:filename>')
@@ -122,153 +286,246 @@ def serve_static_files(filename):
     if filename.startswith('api/'):
         return 'Not found', 404
     
-    # Check if it's a static file request
-    static_extensions = {
-        '.js': 'application/javascript',
-        '.css': 'text/css',
-        '.html': 'text/html',
-        '.png': 'image/png',
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.gif': 'image/gif',
-        '.svg': 'image/svg+xml',
-        '.woff': 'font/woff',
-        '.woff2': 'font/woff2',
-        '.ttf': 'font/ttf',
-        '.eot': 'application/vnd.ms-fontobject',
-        '.wav': 'audio/wav',
-        '.json': 'application/json'
-    }
-    
     # Skip assets folder - handled by dedicated route
     if filename.startswith('assets/'):
         return 'Not found', 404
-    
-    # Get file extension
-    ext = os.path.splitext(filename)[1].lower()
-    
-    if ext in static_extensions:
-        static_path = os.path.join(BASE_DIR, 'static', filename)
-        if os.path.exists(static_path):
-            return send_from_directory(
-                os.path.join(BASE_DIR, 'static'), 
-                filename, 
-                mimetype=static_extensions[ext]
-            )
-        # If file not in static, try root directory (for level JSON files)
-        root_path = os.path.join(BASE_DIR, filename)
-        if ext == '.json' and os.path.exists(root_path):
-            return send_file(root_path, mimetype='application/json')
-    
+
+    entry = static_files.lookup(filename)
+    if entry is not None:
+        if filename == 'index.html':
+            return payload_response(static_files.page(filename))
+        if entry.payload is not None:
+            return payload_response(entry.payload)
+        # Too large to keep in memory: streamed like /assets
+        with phase('send'):
+            response = send_asset(request, entry.path, entry.mimetype)
+        if response is None:
+            return 'Not found', 404
+        response.headers['Cache-Control'] = CACHE_REVALIDATE
+        return response
+
     # For non-static paths, serve index.html (SPA fallback)
-    try:
-        return send_from_directory(
-            os.path.join(BASE_DIR, 'static'), 
-            'index.html', 
-            mimetype='text/html'
-        )
-    except Exception as e:
-        return jsonify({'error': str(e), 'base_dir': BASE_DIR}), 500
-
-# Health check endpoint
-@app.route('/health')
-def health():
+    payload = static_files.page('index.html')
+    if payload is None:
+        return 'Not found', 404
+    return payload_response(payload)
+
+# Set CCB_DEBUG=1 to include paths and directory listings in health
+# responses; they are left out by default
+DEBUG_HEALTH = os.environ.get('CCB_DEBUG', '') not in ('', '0')
+
+# Static files the page cannot work without
+REQUIRED_STATIC = ['index.html', 'game.js', 'style.css']
+
+def check_levels():
+    """Readiness check: every kind of level has data and the manifest builds."""
+    empty = [kind for kind in (CHAR_LEVELS, IDIOM_LEVELS)
+             if not level_registry.level_numbers(kind)]
+    if empty:
+        return f'no level data for {", ".join(empty)}'
+    level_registry.manifest()
+    return None
+
+def check_static():
+    """Readiness check: the required static files are in the file table."""
+    missing = [name for name in REQUIRED_STATIC
+               if static_files.lookup(name) is None]
+    if missing:
+        return f'missing {", ".join(missing)}'
+    return None
+
+readiness = Readiness([('levels', check_levels), ('static', check_static)],
+                      ttl=float(os.environ.get('CCB_READY_TTL', '10')),
+                      debug=DEBUG_HEALTH)
+
+LIVE_BODY = b'{"status":"ok"}'
+
+def health_debug():
+    """Deployment details for CCB_DEBUG; these touch the filesystem."""
     static_dir = os.path.join(BASE_DIR, 'static')
-    return jsonify({
-        'status': 'ok',
+    return {
         'base_dir': BASE_DIR,
         'cwd': os.getcwd(),
+        'corpus_version': level_registry.corpus_version,
         'static_folder': os.path.exists(static_dir),
-        'index_exists': os.path.exists(os.path.join(static_dir, 'index.html')),
-        'game_js_exists': os.path.exists(os.path.join(static_dir, 'game.js')),
-        'style_css_exists': os.path.exists(os.path.join(static_dir, 'style.css')),
-        'level1_exists': os.path.exists(os.path.join(BASE_DIR, 'level1.json')),
+        'static_files': sorted(static_files.urls()),
         'files_in_base': os.listdir(BASE_DIR) if os.path.exists(BASE_DIR) else []
-    })
+    }
+
+# Liveness probe: constant response, no checks
+@app.route('/health/live')
+def health_live():
+    response = Response(LIVE_BODY, mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def readiness_report():
+    """Return (status code, body) for the readiness probe."""
+    result = readiness.status()
+    body = {'status': 'ok' if result['ready'] else 'unavailable'}
+    body.update(result)
+    body['boot'] = BOOT_TIMING
+    if DEBUG_HEALTH:
+        body['debug'] = health_debug()
+    return (200 if result['ready'] else 503), body
+
+# Readiness probe: cached checks of level data and static files
+@app.route('/health/ready')
+@app.route('/health')
+def health_ready():
+    status, body = readiness_report()
+    response = jsonify(body)
+    response.status_code = status
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# Prometheus metrics of this process: requests, latency and response
+# size per route, cache hits and misses, uptime
+@app.route('/metrics')
+def metrics():
+    response = Response(METRICS.render(),
+                        content_type=METRICS_CONTENT_TYPE)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 # API endpoint to load level data
 @app.route('/api/levels/<int:level_num>')
 def get_level(level_num):
-    """Load character level data."""
-    json_path = os.path.join(BASE_DIR, f'level{level_num}.json')
-    txt_path = os.path.join(BASE_DIR, f'level{level_num}.txt')
-    
-    level_map = {}
-    if os.path.exists(json_path):
-        try:
-            import json
-            with open(json_path, 'r', encoding='utf-8-sig') as f:
-                data = json.load(f)
-            if isinstance(data, list):
-                for item in data:
-                    ch = item.get('character') or item.get('char')
-                    py = item.get('pinyin') or item.get('py')
-                    if ch and py:
-                        level_map[ch] = py
-            elif isinstance(data, dict):
-                level_map = data
-        except Exception as e:
-            print(f'Error loading level {level_num}: {e}')
-            pass
-    else:
-        print(f'Level file not found: {json_path}')
-    
-    if not level_map and os.path.exists(txt_path):
-        try:
-            with open(txt_path, 'r', encoding='utf-8-sig') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    parts = line.split()
-                    if len(parts) >= 2:
-                        ch = parts[0]
-                        py = parts[1]
-                        level_map[ch] = py
-        except Exception:
-            pass
-    
-    return jsonify(level_map)
+    """Serve character level data from the level registry."""
+    return payload_response(level_registry.payload(CHAR_LEVELS, level_num))
 
 # API endpoint to load idiom level data
 @app.route('/api/idioms/<int:level_num>')
 def get_idiom_level(level_num):
-    """Load idiom level data."""
-    json_path = os.path.join(BASE_DIR, f'idiom_level{level_num}.json')
-    txt_path = os.path.join(BASE_DIR, f'idiom_level{level_num}.txt')
-    
-    idioms = []
-    if os.path.exists(json_path):
-        try:
-            import json
-            with open(json_path, 'r', encoding='utf-8-sig') as f:
-                data = json.load(f)
-            if isinstance(data, list):
-                for item in data:
-                    if isinstance(item, str):
-                        idioms.append(item)
-                    elif isinstance(item, dict):
-                        val = item.get('idiom')
-                        if isinstance(val, str):
-                            idioms.append(val)
-        except Exception:
-            pass
-    
-    if not idioms and os.path.exists(txt_path):
-        try:
-            with open(txt_path, 'r', encoding='utf-8-sig') as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        idioms.append(line)
-        except Exception:
-            pass
-    
-    return jsonify(idioms)
+    """Serve idiom level data from the level registry."""
+    return payload_response(level_registry.payload(IDIOM_LEVELS, level_num))
+
+# API endpoint to load every level in one response
+@app.route('/api/bundle')
+def get_bundle():
+    """Serve all character and idiom levels as one compressed payload."""
+    return payload_response(level_registry.bundle())
+
+# Content manifest: level counts plus a hash and size for every level
+@app.route('/api/manifest')
+def get_manifest():
+    """Serve the level content manifest."""
+    return payload_response(level_registry.manifest())
+
+# Compact v2 API: characters as one string plus pinyin indexes into a
+# shared syllable table
+@app.route('/api/v2/syllables')
+def get_syllables():
+    """Serve the interned pinyin syllable table."""
+    return payload_response(level_registry.syllables())
+
+@app.route('/api/v2/levels/<int:level_num>')
+def get_compact_level(level_num):
+    """Serve a character level in the compact v2 format."""
+    return payload_response(level_registry.compact(level_num))
+
+@app.route('/api/v2/bundle')
+def get_compact_bundle():
+    """Serve every level in the v2 format along with the syllable table."""
+    return payload_response(level_registry.compact_bundle())
 
 # Vercel automatically detects Flask apps and creates the handler
 # No need to manually define handler - just export the app
 
-if __name__ == '__main__':
+BOOT_TIMING = {
+    'cold_start': COLD_START,
+    'import_ms': round((IMPORTS_DONE - BOOT_STARTED) * 1000, 1),
+    'boot_ms': round((time.perf_counter() - BOOT_STARTED) * 1000, 1),
+    'level_data': level_registry.source() if COLD_START else 'lazy',
+}
+
+def preload():
+    """Build every payload up front, so forked workers share them."""
+    payloads = list(level_registry.all_payloads().values())
+    payloads += [static_files.get(url) for url in static_files.urls()]
+    payloads += [static_files.page('index.html'), service_worker_payload()]
+    for payload in payloads:
+        if payload is not None and payload.compressible:
+            payload.gzip_body
+    readiness.status()
+
+def main(argv=None):
+    # Only needed on the command line, not when imported as the app
+    import argparse
+    from corpus import compile_levels
+
+    parser = argparse.ArgumentParser(
+        description='Chinese Character Block game server')
+    commands = parser.add_subparsers(dest='command')
+
+    compile_parser = commands.add_parser(
+        'compile-levels',
+        help=f'validate level files and write {CORPUS_FILENAME}')
+    compile_parser.add_argument(
+        '--output', default=CORPUS_PATH,
+        help='artifact path (default: %(default)s)')
+    compile_parser.add_argument(
+        '--strict', action='store_true',
+        help='treat warnings as errors')
+    compile_parser.add_argument(
+        '--check', action='store_true',
+        help='only verify that the artifact is up to date')
+
+    serve_parser = commands.add_parser(
+        'serve', help='run the production server with prefork workers')
+    serve_parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='address to listen on (default: %(default)s)')
+    serve_parser.add_argument(
+        '--port', type=int, default=int(os.environ.get('PORT', 5000)),
+        help='port to listen on (default: $PORT or 5000)')
+    serve_parser.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1,
+        help='worker processes (default: one per CPU, %(default)s)')
+    serve_parser.add_argument(
+        '--threads', type=int, default=8,
+        help='request threads per worker (default: %(default)s)')
+    serve_parser.add_argument(
+        '--max-requests', type=int, default=0,
+        help='replace a worker after this many requests (default: never)')
+    serve_parser.add_argument(
+        '--max-requests-jitter', type=int, default=0,
+        help='add up to this many requests to --max-requests per worker')
+
+    export_parser = commands.add_parser(
+        'export', help='write the whole site as static files')
+    export_parser.add_argument(
+        '--output', default=os.path.join(BASE_DIR, 'dist'),
+        help='output directory (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        from export import export_site
+        return export_site(args.output, level_registry, static_files,
+                           service_worker_payload,
+                           assets_dir=os.path.join(BASE_DIR, 'assets'))
+    if args.command == 'compile-levels':
+        return compile_levels(BASE_DIR, args.output,
+                              strict=args.strict, check=args.check)
+    if args.command == 'serve':
+        from server import serve
+        if args.workers and hasattr(os, 'fork'):
+            # The parent only forks workers, and each polls for level
+            # and static file edits itself; a parent rebuilding while it
+            # forks could hand a worker a half-recorded reload
+            level_registry.stop()
+            static_files.stop()
+        return serve(app, host=args.host, port=args.port,
+                     workers=args.workers, threads=args.threads,
+                     max_requests=args.max_requests,
+                     max_requests_jitter=args.max_requests_jitter,
+                     preload=preload)
+
+    # Pick up edits to static files without restarting the dev server
+    static_files.auto_reload = True
     app.run(debug=True, port=5000)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
 
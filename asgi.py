@@ -0,0 +1,374 @@
+"""ASGI version of the game server, for async hosting.
+
+Serves the same routes as app.py from the same level registry and static
+file table, so responses are byte for byte the same; only the server
+interface differs. Run it under any ASGI server, e.g.
+
+    uvicorn asgi:app --workers 4
+
+Every level and static payload is built during lifespan startup, so
+request handlers only look up pre-encoded bytes and never block the event
+loop. Files under /assets are read from disk on the default executor.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from stat import S_ISREG
+from urllib.parse import parse_qs
+
+from werkzeug.http import (http_date, parse_etags, parse_if_range_header,
+                           parse_range_header, quote_etag)
+from werkzeug.security import safe_join
+
+from app import (BASE_DIR, FINGERPRINTED, FINGERPRINT_LENGTH, LIVE_BODY,
+                 cors_policy, level_registry, preload, rate_limit,
+                 readiness_report, service_worker_payload, static_files)
+from cors import ALLOWED_METHODS
+from levels import CHAR_LEVELS, IDIOM_LEVELS
+from media import (CHUNK_SIZE, asset_mimetype, file_etag, if_range_matches,
+                   resolve_ranges)
+from logs import log_access
+from metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, METRICS,
+                     record_request)
+from payloads import CACHE_REVALIDATE, negotiate
+
+logger = logging.getLogger(__name__)
+
+ASSETS_DIR = os.path.join(BASE_DIR, 'assets')
+
+NOT_FOUND = (404, [('Content-Type', 'text/html; charset=utf-8')],
+             b'Not found')
+
+
+class Request(object):
+    """The parts of an ASGI HTTP scope the routes need."""
+
+    __slots__ = ('method', 'path', 'query', 'headers', 'client')
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.client = (scope.get('client') or ('', 0))[0]
+        self.query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            if name in headers:
+                value = f'{headers[name]}, {value}'
+            headers[name] = value
+        self.headers = headers
+
+    def arg(self, name):
+        values = self.query.get(name)
+        return values[0] if values else None
+
+
+def payload_reply(request, payload, immutable=None):
+    """Return (status, headers, body) for a pre-encoded payload."""
+    if payload is None:
+        return NOT_FOUND
+    return negotiate(
+        payload,
+        accept_encoding=request.headers.get('accept-encoding'),
+        if_none_match=request.headers.get('if-none-match'),
+        if_modified_since=request.headers.get('if-modified-since'),
+        version=request.arg('v'),
+        immutable=immutable)
+
+
+def json_reply(status, data, cache_control='no-store'):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return status, [('Content-Type', 'application/json'),
+                    ('Cache-Control', cache_control)], body
+
+
+def level(kind):
+    return lambda request, match: payload_reply(
+        request, level_registry.payload(kind, int(match.group(1))))
+
+
+def fingerprinted(request, match):
+    name, digest, ext = match.groups()
+    filename = f'{name}.{ext}'
+    if filename not in FINGERPRINTED:
+        return static(request, f'{name}.{digest}.{ext}')
+    payload = static_files.get(filename)
+    if payload is None:
+        return NOT_FOUND
+    return payload_reply(
+        request, payload,
+        immutable=digest == payload.version[:FINGERPRINT_LENGTH])
+
+
+def service_worker(request, match):
+    status, headers, body = payload_reply(request, service_worker_payload())
+    if status != 404:
+        headers.append(('Service-Worker-Allowed', '/'))
+    return status, headers, body
+
+
+def health_ready(request, match):
+    return json_reply(*readiness_report())
+
+
+def static(request, filename):
+    """The catch-all route: static file table, then the SPA page."""
+    if filename.startswith('api/'):
+        return NOT_FOUND
+    entry = static_files.lookup(filename)
+    if entry is not None:
+        if filename == 'index.html':
+            return payload_reply(request, static_files.page(filename))
+        if entry.payload is not None:
+            return payload_reply(request, entry.payload)
+        return entry
+    return payload_reply(request, static_files.page('index.html'))
+
+
+# (pattern, rule, handler) triples, tried in order. rule is the Flask
+# rule of the same route in app.py; it labels the route in metrics and
+# access logs, so both apps report the same series. Handlers return
+# (status, headers, body), or a StaticEntry / file path to stream
+ROUTES = [
+    (r'/api/levels/(\d+)', '/api/levels/<int:level_num>',
+     level(CHAR_LEVELS)),
+    (r'/api/idioms/(\d+)', '/api/idioms/<int:level_num>',
+     level(IDIOM_LEVELS)),
+    (r'/api/bundle', '/api/bundle', lambda request, match: payload_reply(
+        request, level_registry.bundle())),
+    (r'/api/manifest', '/api/manifest', lambda request, match: payload_reply(
+        request, level_registry.manifest())),
+    (r'/api/v2/syllables', '/api/v2/syllables',
+     lambda request, match: payload_reply(
+         request, level_registry.syllables())),
+    (r'/api/v2/levels/(\d+)', '/api/v2/levels/<int:level_num>',
+     lambda request, match: payload_reply(
+         request, level_registry.compact(int(match.group(1))))),
+    (r'/api/v2/bundle', '/api/v2/bundle',
+     lambda request, match: payload_reply(
+         request, level_registry.compact_bundle())),
+    (r'/', '/', lambda request, match: payload_reply(
+        request, static_files.page('index.html'))),
+    (r'/game\.js', '/game.js', lambda request, match: payload_reply(
+        request, static_files.get('game.js'))),
+    (r'/style\.css', '/style.css', lambda request, match: payload_reply(
+        request, static_files.get('style.css'))),
+    (r'/sw\.js', '/sw.js', service_worker),
+    (r'/health/live', '/health/live', lambda request, match: (
+        200, [('Content-Type', 'application/json'),
+              ('Cache-Control', 'no-store')], LIVE_BODY)),
+    (r'/health/ready', '/health/ready', health_ready),
+    (r'/health', '/health', health_ready),
+    (r'/metrics', '/metrics', lambda request, match: (
+        200, [('Content-Type', METRICS_CONTENT_TYPE),
+              ('Cache-Control', 'no-store')], METRICS.render())),
+    (r'/assets/(.+)', '/assets/<path:filename>',
+     lambda request, match: safe_join(
+         ASSETS_DIR, match.group(1)) or NOT_FOUND),
+    (r'/([^/]+)\.([^/.]+)\.(js|css)', '/<name>.<digest>.<any(js, css):ext>',
+     fingerprinted),
+    (r'/(.+)', '/<path:filename>',
+     lambda request, match: static(request, match.group(1))),
+]
+ROUTES = [(re.compile(pattern + '$'), rule, handler)
+          for pattern, rule, handler in ROUTES]
+
+
+def match_route(path):
+    """Return (rule, handler, match) for a path.
+
+    A path no route matches gets ('unmatched', None, None).
+    """
+    for pattern, rule, handler in ROUTES:
+        match = pattern.match(path)
+        if match:
+            return rule, handler, match
+    return 'unmatched', None, None
+
+
+def _read(f, start, length):
+    f.seek(start)
+    return f.read(length)
+
+
+async def send_file(send, request, path, mimetype, head):
+    """Stream a file from disk, honouring a single byte range.
+
+    Anything but a regular file, or a file that cannot be opened, gets a
+    404; a read error once the response has started ends it early.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        stat = await loop.run_in_executor(None, os.stat, path)
+    except OSError:
+        stat = None
+    f = None
+    if stat is not None and S_ISREG(stat.st_mode):
+        try:
+            f = await loop.run_in_executor(None, open, path, 'rb')
+        except OSError:
+            pass
+    if f is None:
+        await send_reply(send, NOT_FOUND, head)
+        return
+    try:
+        await _send_open_file(send, request, f, stat, mimetype, head)
+    finally:
+        f.close()
+
+
+async def _send_open_file(send, request, f, stat, mimetype, head):
+    loop = asyncio.get_running_loop()
+    size = stat.st_size
+    etag = file_etag(stat)
+    headers = [('ETag', quote_etag(etag)),
+               ('Cache-Control', CACHE_REVALIDATE)]
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        await send_reply(send, (304, headers, b''), head)
+        return
+    headers += [('Content-Type', mimetype), ('Accept-Ranges', 'bytes'),
+                ('Last-Modified', http_date(stat.st_mtime))]
+
+    status, start, stop = 200, 0, size
+    byte_range = parse_range_header(request.headers.get('range'))
+    if_range = parse_if_range_header(request.headers.get('if-range'))
+    # Multiple ranges are answered with the whole file, as RFC 9110 allows
+    if (byte_range is not None and byte_range.units == 'bytes' and
+            len(byte_range.ranges) == 1 and
+            if_range_matches(if_range, etag, stat.st_mtime)):
+        spans = resolve_ranges(byte_range.ranges, size)
+        if not spans:
+            await send_reply(send, (416, [('Content-Range',
+                                           f'bytes */{size}')], b''), head)
+            return
+        status, (start, stop) = 206, spans[0]
+        headers.append(('Content-Range', f'bytes {start}-{stop - 1}/{size}'))
+    await send_start(send, status, headers, stop - start)
+    if head:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    while start < stop:
+        try:
+            chunk = await loop.run_in_executor(
+                None, _read, f, start, min(CHUNK_SIZE, stop - start))
+        except OSError:
+            logger.warning('Reading %s failed mid-response', f.name,
+                           exc_info=True)
+            break
+        if not chunk:
+            break
+        start += len(chunk)
+        await send({'type': 'http.response.body', 'body': chunk,
+                    'more_body': start < stop})
+    if start < stop:
+        # The file shrank (or failed) while we were sending it; end the
+        # response
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def _add_cors(headers, cors):
+    """Return encoded response headers with the CORS headers added."""
+    headers = list(headers)
+    for name, value in cors:
+        name, value = name.lower().encode('latin-1'), value.encode('latin-1')
+        if name == b'vary':
+            for i, (existing, values) in enumerate(headers):
+                if existing == b'vary':
+                    headers[i] = (existing, values + b', ' + value)
+                    break
+            else:
+                headers.append((name, value))
+        else:
+            headers.append((name, value))
+    return headers
+
+
+async def send_start(send, status, headers, length):
+    headers = list(headers)
+    if status not in (204, 304):
+        headers.append(('Content-Length', str(length)))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+    })
+
+
+async def send_reply(send, reply, head=False):
+    status, headers, body = reply
+    await send_start(send, status, headers, len(body))
+    await send({'type': 'http.response.body',
+                'body': b'' if head else body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, preload)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed',
+                            'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    request = Request(scope)
+    started = time.perf_counter()
+    origin = request.headers.get('origin')
+    cors = cors_policy.headers(request.path, origin)
+    head = request.method == 'HEAD'
+    rule, handler, match = match_route(request.path)
+    if request.method == 'OPTIONS':
+        # Answered by the CORS policy, like in the Flask app
+        reply = cors_policy.options(
+            request.path, origin,
+            request.headers.get('access-control-request-method'))
+    elif not head and request.method != 'GET':
+        rule, reply = 'unmatched', (405, [('Allow', ALLOWED_METHODS)], b'')
+    else:
+        reply = rate_limit(request.path, request.client,
+                           request.headers.get('x-forwarded-for'))
+        if reply is None:
+            reply = NOT_FOUND if handler is None else handler(request, match)
+    sent = {'status': 500, 'size': 0}
+
+    async def send_counted(message):
+        if message['type'] == 'http.response.start':
+            sent['status'] = message['status']
+            if cors:
+                message['headers'] = _add_cors(message['headers'], cors)
+        else:
+            sent['size'] += len(message.get('body', b''))
+        await send(message)
+
+    if isinstance(reply, tuple):
+        await send_reply(send_counted, reply, head)
+    elif isinstance(reply, str):
+        await send_file(send_counted, request, reply, asset_mimetype(reply),
+                        head)
+    else:
+        await send_file(send_counted, request, reply.path, reply.mimetype,
+                        head)
+    elapsed = time.perf_counter() - started
+    record_request(rule, request.method, sent['status'], elapsed,
+                   sent['size'])
+    log_access(rule, request.method, request.path, sent['status'],
+               elapsed, sent['size'])
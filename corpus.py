@@ -0,0 +1,354 @@
+"""Compiled level corpus: validation, the compile-levels command and the
+artifact format.
+
+The artifact is a single file the server reads at startup:
+
+    MAGIC (8 bytes) | header length (uint32, big-endian) | header | data
+
+The header is UTF-8 JSON:
+
+    {"format": 2,
+     "version": <hash of every plain payload body>,
+     "numbers": {"levels": [1, 2, ...], "idioms": [1, 2, ...]},
+     "entries": {"levels/1": [offset, length, etag, last_modified,
+                              gzip_offset, gzip_length], ...}}
+
+and the data section is every registry payload body, followed by its
+gzip variant when the payload is compressible (otherwise the gzip fields
+are null). A payload is served by slicing data[offset:offset + length].
+
+At runtime the artifact is memory-mapped read-only (MappedCorpus), so
+payload bodies are memoryview slices of the map: no per-process copies
+of the level data, and pages are shared by every worker forked after the
+map was opened. Short-lived serverless instances read it instead, with a
+single read() (MappedCorpus(path, mapped=False)), rather than paying a
+page fault per first touch of each payload.
+"""
+import json
+import mmap
+import os
+import struct
+
+from levels import (CHAR_LEVELS, IDIOM_LEVELS, LevelRegistry,
+                    scan_level_sources)
+from payloads import content_hash
+
+MAGIC = b'CCBLVL02'
+FORMAT = 2
+CORPUS_FILENAME = 'levels.bin'
+
+_HEADER_LENGTH = struct.Struct('>I')
+
+
+class CorpusError(Exception):
+    """Raised when a corpus artifact cannot be read."""
+
+
+def build_corpus(registry):
+    """Encode every payload of registry into artifact bytes."""
+    payloads = registry.all_payloads()
+    entries = {}
+    chunks = []
+    offset = 0
+    for key in sorted(payloads):
+        payload = payloads[key]
+        entry = [offset, len(payload.body), payload.version,
+                 payload.last_modified, None, None]
+        chunks.append(payload.body)
+        offset += len(payload.body)
+        if payload.compressible:
+            entry[4:] = [offset, len(payload.gzip_body)]
+            chunks.append(payload.gzip_body)
+            offset += len(payload.gzip_body)
+        entries[key] = entry
+    # The version only covers plain bodies, so it does not depend on the
+    # zlib build that produced the gzip variants
+    version = content_hash(b''.join(
+        payloads[key].body for key in sorted(payloads)))
+    data = b''.join(chunks)
+    header = json.dumps({
+        'format': FORMAT,
+        'version': version,
+        'numbers': {kind: registry.level_numbers(kind)
+                    for kind in (CHAR_LEVELS, IDIOM_LEVELS)},
+        'entries': entries,
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return MAGIC + _HEADER_LENGTH.pack(len(header)) + header + data
+
+
+def parse_corpus(blob):
+    """Split artifact bytes into (header dict, data section)."""
+    if blob[:len(MAGIC)] != MAGIC:
+        raise CorpusError('not a level corpus (bad magic)')
+    start = len(MAGIC) + _HEADER_LENGTH.size
+    if len(blob) < start:
+        raise CorpusError('truncated corpus header')
+    (header_length,) = _HEADER_LENGTH.unpack_from(blob, len(MAGIC))
+    try:
+        header = json.loads(bytes(blob[start:start + header_length]))
+    except ValueError as e:
+        raise CorpusError(f'corrupt corpus header: {e}')
+    if header.get('format') != FORMAT:
+        raise CorpusError(f'unsupported corpus format {header.get("format")}')
+    data = blob[start + header_length:]
+    for offset, length, _, _, gzip_offset, gzip_length in (
+            header['entries'].values()):
+        if (offset + length > len(data) or
+                (gzip_offset or 0) + (gzip_length or 0) > len(data)):
+            raise CorpusError('truncated corpus data')
+    return header, data
+
+
+def read_corpus(path):
+    """Read a corpus artifact with a single read of the file."""
+    with open(path, 'rb') as f:
+        blob = f.read()
+    return parse_corpus(blob)
+
+
+class MappedCorpus(object):
+    """Read-only memory map of a corpus artifact.
+
+    slice() and the payload bodies built by the level registry are
+    zero-copy memoryview segments of the map, found through the header's
+    offset table. With mapped=False the file is read into memory in one
+    read instead, and slices are views of that buffer.
+    """
+
+    def __init__(self, path, mapped=True):
+        with open(path, 'rb') as f:
+            if not mapped:
+                self._map = f.read()
+            else:
+                try:
+                    self._map = mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+                except ValueError as e:
+                    # Raised for empty files, which cannot be mapped
+                    raise CorpusError(f'cannot map {path}: {e}')
+        self.mapped = mapped
+        self.header, self.data = parse_corpus(memoryview(self._map))
+        self.version = self.header['version']
+
+    def entries(self):
+        """Return the header offset table, {key: entry}."""
+        return self.header['entries']
+
+    def slice(self, offset, length):
+        """Return length bytes at offset of the data section, uncopied."""
+        if offset is None:
+            return None
+        return self.data[offset:offset + length]
+
+
+def write_corpus(path, blob):
+    """Write artifact bytes so readers never see a partial file."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def _read_source(path, problems):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    name = os.path.basename(path)
+    if raw.startswith(b'\xef\xbb\xbf'):
+        problems.warn(f'{name}: starts with a UTF-8 BOM (stripped)')
+    try:
+        return raw.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        problems.error(f'{name}: not valid UTF-8 ({e})')
+        return None
+
+
+def _parse_char_source(base_dir, level_num, problems):
+    """Return [(character, pinyin)] for a level, reporting bad entries."""
+    json_path = os.path.join(base_dir, f'level{level_num}.json')
+    txt_path = os.path.join(base_dir, f'level{level_num}.txt')
+    entries = []
+    if os.path.exists(json_path):
+        name = os.path.basename(json_path)
+        text = _read_source(json_path, problems)
+        if text is None:
+            return entries
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            problems.error(f'{name}: invalid JSON ({e})')
+            return entries
+        if isinstance(data, dict):
+            items = [{'character': ch, 'pinyin': py}
+                     for ch, py in data.items()]
+        elif isinstance(data, list):
+            items = data
+        else:
+            problems.error(f'{name}: expected a list or an object')
+            return entries
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                problems.error(f'{name}[{i}]: expected an object')
+                continue
+            ch = item.get('character') or item.get('char')
+            py = item.get('pinyin') or item.get('py')
+            entries.append((f'{name}[{i}]', ch, py))
+    else:
+        name = os.path.basename(txt_path)
+        text = _read_source(txt_path, problems)
+        if text is None:
+            return entries
+        for lineno, line in enumerate(text.splitlines(), 1):
+            parts = line.split()
+            if parts:
+                entries.append((f'{name}:{lineno}', parts[0],
+                                parts[1] if len(parts) > 1 else None))
+
+    result = []
+    for where, ch, py in entries:
+        if not isinstance(ch, str) or not ch.strip():
+            problems.error(f'{where}: empty character')
+        elif len(ch) != 1:
+            problems.error(f'{where}: {ch!r} is not a single character')
+        elif not isinstance(py, str) or not py.strip():
+            problems.error(f'{where}: empty pinyin for {ch}')
+        else:
+            result.append((ch, py))
+    if not result:
+        problems.error(f'character level {level_num} has no entries')
+    return result
+
+
+def _parse_idiom_source(base_dir, level_num, problems):
+    """Return the idioms of a level, reporting bad entries."""
+    json_path = os.path.join(base_dir, f'idiom_level{level_num}.json')
+    txt_path = os.path.join(base_dir, f'idiom_level{level_num}.txt')
+    idioms = None
+    if os.path.exists(json_path):
+        name = os.path.basename(json_path)
+        text = _read_source(json_path, problems)
+        try:
+            data = json.loads(text) if text is not None else []
+        except ValueError as e:
+            problems.error(f'{name}: invalid JSON ({e})')
+            data = []
+        if not isinstance(data, list):
+            problems.error(f'{name}: expected a list')
+            data = []
+        idioms = []
+        for i, item in enumerate(data):
+            if isinstance(item, dict):
+                item = item.get('idiom')
+            if not isinstance(item, str) or not item.strip():
+                problems.error(f'{name}[{i}]: empty or missing idiom')
+                continue
+            idioms.append(item)
+
+    if os.path.exists(txt_path):
+        text = _read_source(txt_path, problems)
+        lines = [line.strip() for line in (text or '').splitlines()
+                 if line.strip()]
+        if idioms is None:
+            idioms = lines
+        elif lines != idioms:
+            problems.warn(f'{os.path.basename(txt_path)}: differs from '
+                          f'{os.path.basename(json_path)} (the JSON is used)')
+
+    if not idioms:
+        problems.error(f'idiom level {level_num} has no entries')
+    return idioms or []
+
+
+class Problems(object):
+    """Errors and warnings collected while validating level sources."""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+def validate_sources(base_dir):
+    """Check every level source file and return the Problems found.
+
+    Errors: unreadable or malformed files, empty characters or pinyin,
+    entries that are not a single character, empty levels and
+    characters that appear more than once. Warnings: BOMs, idioms
+    listed twice, idioms using characters missing from the character
+    levels, and .txt idiom files that disagree with their .json twin.
+    """
+    problems = Problems()
+    numbers = scan_level_sources(base_dir)
+
+    seen = {}
+    for n in numbers[CHAR_LEVELS]:
+        for ch, _ in _parse_char_source(base_dir, n, problems):
+            if ch in seen:
+                problems.error(f'character {ch} is in level {seen[ch]} '
+                               f'and level {n}')
+            else:
+                seen[ch] = n
+
+    seen_idioms = {}
+    missing = {}
+    for n in numbers[IDIOM_LEVELS]:
+        for idiom in _parse_idiom_source(base_dir, n, problems):
+            if idiom in seen_idioms:
+                if seen_idioms[idiom] == n:
+                    problems.warn(f'idiom {idiom} is listed twice in '
+                                  f'idiom level {n}')
+                else:
+                    problems.warn(f'idiom {idiom} is in idiom level '
+                                  f'{seen_idioms[idiom]} and idiom level {n}')
+                continue
+            seen_idioms[idiom] = n
+            for ch in set(idiom):
+                if ch not in seen:
+                    missing.setdefault(ch, []).append(idiom)
+    for ch in sorted(missing):
+        problems.warn(f'character {ch} used by {", ".join(missing[ch])} '
+                      f'is missing from the character levels')
+    return problems
+
+
+def compile_levels(base_dir, output, strict=False, check=False):
+    """Validate level sources and write the corpus artifact.
+
+    Returns a process exit code. With strict, warnings fail the build
+    too. With check, nothing is written and the build fails if output
+    is missing or differs from what would be written.
+    """
+    problems = validate_sources(base_dir)
+    for message in problems.warnings:
+        print(f'warning: {message}')
+    for message in problems.errors:
+        print(f'error: {message}')
+    failed = problems.errors or (strict and problems.warnings)
+    if failed:
+        print(f'compile-levels failed: {len(problems.errors)} errors, '
+              f'{len(problems.warnings)} warnings')
+        return 1
+
+    blob = build_corpus(LevelRegistry(base_dir))
+    header, _ = parse_corpus(blob)
+    if check:
+        try:
+            current, _ = read_corpus(output)
+        except (OSError, CorpusError) as e:
+            print(f'{output} is not usable: {e}')
+            return 1
+        if current['version'] != header['version']:
+            print(f'{output} is out of date; run compile-levels')
+            return 1
+        print(f'{output} is up to date ({header["version"]})')
+        return 0
+
+    write_corpus(output, blob)
+    print(f'Wrote {output}: {len(header["entries"])} payloads, '
+          f'{len(blob)} bytes, version {header["version"]} '
+          f'({len(problems.warnings)} warnings)')
+    return 0
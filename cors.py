@@ -0,0 +1,99 @@
+"""CORS policy: which origins may read which routes, and preflights.
+
+Rules map URL path prefixes to the origins allowed to read them, from
+CCB_CORS, e.g.
+
+    CCB_CORS="/api/=*;/assets/=https://portal.example.edu"
+
+lets any origin read /api/ and a school portal read /assets/ (list more
+origins separated by spaces). The longest matching prefix wins; paths
+without a rule (the page, static files, probes) get no CORS headers,
+since the game reads them from its own origin. The default is "/api/=*".
+
+OPTIONS requests are answered by the policy without reaching a route.
+Preflights get an Access-Control-Max-Age of a day, so a browser sends
+one per URL a day instead of one before every request.
+"""
+
+DEFAULT_RULES = '/api/=*'
+
+# Browsers cap this (Chrome at 2 hours, Firefox at 24)
+MAX_AGE = 86400
+
+ALLOWED_METHODS = 'GET, HEAD, OPTIONS'
+ALLOWED_HEADERS = 'Content-Type, Authorization'
+
+
+def parse_rules(spec):
+    """Parse 'prefix=origin origin;prefix=*' into [(prefix, origins)].
+
+    origins is None for '*', else a frozenset. Rules are sorted longest
+    prefix first.
+    """
+    rules = []
+    for item in filter(None, (part.strip() for part in spec.split(';'))):
+        prefix, sep, origins = item.partition('=')
+        if not sep or not prefix.startswith('/') or not origins.split():
+            raise ValueError(f'bad CORS rule {item!r}; expected '
+                             f'/prefix=origin [origin...] or /prefix=*')
+        origins = origins.split()
+        rules.append((prefix.strip(),
+                      None if origins == ['*'] else frozenset(origins)))
+    return sorted(rules, key=lambda rule: len(rule[0]), reverse=True)
+
+
+class CorsPolicy(object):
+    """Per-route CORS headers and preflight responses.
+
+    Both methods return plain (name, value) header lists, so the Flask
+    app and the ASGI app share them.
+    """
+
+    def __init__(self, rules, max_age=MAX_AGE):
+        self.rules = rules
+        self._preflight = [
+            ('Access-Control-Allow-Methods', ALLOWED_METHODS),
+            ('Access-Control-Allow-Headers', ALLOWED_HEADERS),
+            ('Access-Control-Max-Age', str(max_age)),
+        ]
+
+    def _origins(self, path):
+        for prefix, origins in self.rules:
+            if path.startswith(prefix):
+                return True, origins
+        return False, None
+
+    def allows(self, path, origin):
+        """Return True if origin may read path."""
+        matched, origins = self._origins(path)
+        return matched and (origins is None or origin in origins)
+
+    def headers(self, path, origin):
+        """Return the CORS headers of a response to path.
+
+        Routes open to any origin get 'Access-Control-Allow-Origin: *'
+        whether or not the request names an origin, so shared caches can
+        store one copy. Routes open to listed origins echo an allowed
+        origin and add 'Vary: Origin'.
+        """
+        matched, origins = self._origins(path)
+        if not matched:
+            return []
+        if origins is None:
+            return [('Access-Control-Allow-Origin', '*')]
+        if origin in origins:
+            return [('Access-Control-Allow-Origin', origin),
+                    ('Vary', 'Origin')]
+        return [('Vary', 'Origin')]
+
+    def options(self, path, origin, request_method):
+        """Return (status, headers, body) answering an OPTIONS request.
+
+        A preflight (request_method set) for an allowed origin gets the
+        allowed methods and headers and Max-Age; the origin itself is
+        added by headers(), like for any other response.
+        """
+        headers = [('Allow', ALLOWED_METHODS)]
+        if request_method and origin and self.allows(path, origin):
+            headers += self._preflight
+        return 204, headers, b''
@@ -0,0 +1,139 @@
+"""Static export of the whole site (python app.py export).
+
+Every response the app sends is built from files that do not change at
+runtime, so the site can be written out once and served by any static
+host or CDN:
+
+    dist/index.html                 page, referencing the hashed files
+    dist/game.<hash>.js, ...        fingerprinted script and stylesheet
+    dist/game.js, style.css, sw.js  the rest of static/
+    dist/assets/...                 media files
+    dist/api/levels/1, ...          every API response, at its API path
+    dist/<file>.gz                  gzip variant of compressible files
+    dist/_headers                   Content-Type and Cache-Control rules
+    dist/_redirects                 SPA fallback to index.html
+
+API responses keep their exact paths (no .json extension), so the game
+fetches them unchanged; _headers gives them their JSON content type.
+_headers and _redirects use the format of Netlify and Cloudflare Pages;
+the .gz files are for servers that serve precompressed variants (nginx
+gzip_static, Caddy precompressed).
+"""
+import os
+import shutil
+
+from werkzeug.utils import get_content_type
+
+from payloads import CACHE_IMMUTABLE, CACHE_REVALIDATE
+from static_files import FINGERPRINTED
+
+HEADERS_FILE = '_headers'
+REDIRECTS_FILE = '_redirects'
+
+
+class ExportError(Exception):
+    """Raised when the output directory cannot be used."""
+
+
+def _write(root, url, data):
+    path = os.path.join(root, *url.strip('/').split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class SiteExport(object):
+    """Collects the files and header rules of a static export."""
+
+    def __init__(self, root):
+        self.root = root
+        self.files = 0
+        self.size = 0
+        self._headers = []
+
+    def payload(self, url, payload, cache_control=CACHE_REVALIDATE,
+                extra_headers=()):
+        """Write payload at url, plus url.gz if it is compressible."""
+        body = bytes(payload.body)
+        _write(self.root, url, body)
+        self.files += 1
+        self.size += len(body)
+        if payload.compressible:
+            _write(self.root, f'{url}.gz', bytes(payload.gzip_body))
+            self.files += 1
+        headers = [('Content-Type',
+                    get_content_type(payload.mimetype, 'utf-8')),
+                   ('Cache-Control', cache_control)]
+        self._headers.append((url, headers + list(extra_headers)))
+
+    def copy_tree(self, source, url):
+        """Copy a directory of files that need no header rules."""
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(self.root, url.strip('/')))
+            for _, _, files in os.walk(source):
+                self.files += len(files)
+
+    def finish(self):
+        """Write _headers and _redirects."""
+        lines = ['# Generated by python app.py export']
+        for url, headers in self._headers:
+            lines.append(url)
+            lines.extend(f'  {name}: {value}' for name, value in headers)
+        _write(self.root, HEADERS_FILE, ('\n'.join(lines) + '\n').encode())
+        _write(self.root, REDIRECTS_FILE, b'/*    /index.html    200\n')
+        self.files += 2
+
+
+def prepare_output(output):
+    """Empty output for a new export, refusing to clear unrelated files."""
+    if os.path.isdir(output) and os.listdir(output):
+        if not os.path.exists(os.path.join(output, HEADERS_FILE)):
+            raise ExportError(f'{output} is not empty and is not a previous '
+                              f'export; choose another --output')
+        shutil.rmtree(output)
+    elif os.path.exists(output) and not os.path.isdir(output):
+        raise ExportError(f'{output} is not a directory')
+    os.makedirs(output, exist_ok=True)
+
+
+def export_site(output, registry, static_files, service_worker_payload,
+                assets_dir=None):
+    """Write the static site to output; return a process exit code."""
+    try:
+        prepare_output(output)
+    except ExportError as e:
+        print(f'export failed: {e}')
+        return 1
+    site = SiteExport(output)
+
+    site.payload('/index.html', static_files.page('index.html'))
+    for name in FINGERPRINTED:
+        site.payload(f'/{static_files.fingerprinted(name)}',
+                     static_files.get(name), cache_control=CACHE_IMMUTABLE)
+    static_dir = os.path.abspath(static_files.directory)
+    for url in sorted(static_files.urls()):
+        entry = static_files.lookup(url)
+        # Only static/ itself; level source files are exported as API
+        # responses below
+        if (url in ('index.html', 'sw.js') or
+                not os.path.abspath(entry.path).startswith(static_dir)):
+            continue
+        if entry.payload is None:
+            path = os.path.join(output, *url.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(entry.path, path)
+            site.files += 1
+        else:
+            site.payload(f'/{url}', entry.payload)
+    site.payload('/sw.js', service_worker_payload(),
+                 extra_headers=[('Service-Worker-Allowed', '/')])
+
+    for key, payload in sorted(registry.all_payloads().items()):
+        site.payload(f'/api/{key}', payload)
+    if assets_dir is not None:
+        site.copy_tree(assets_dir, '/assets')
+    site.finish()
+
+    print(f'Exported {site.files} files ({site.size} bytes before '
+          f'compression) to {output}')
+    return 0
@@ -0,0 +1,60 @@
+"""Liveness and readiness probes.
+
+Liveness only says the process answers requests. Readiness runs real
+checks (level data loads, static files are indexed), but at most once per
+ttl seconds: probes in between get the cached result, so uptime checkers
+and load balancers cost no filesystem access.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness(object):
+    """Cached result of a list of named readiness checks.
+
+    Each check is a callable that returns None when healthy, or a short
+    description of the problem. A check that raises is logged with its
+    traceback and reported as 'check raised <exception type>'; the
+    message, which may name server paths, is only included with debug.
+    """
+
+    def __init__(self, checks, ttl=10.0, debug=False):
+        self.checks = checks
+        self.ttl = ttl
+        self.debug = debug
+        self._lock = threading.Lock()
+        self._result = None
+        self._expires = 0.0
+
+    def _run(self):
+        problems = {}
+        for name, check in self.checks:
+            try:
+                problem = check()
+            except Exception as e:
+                logger.exception('Readiness check %s raised', name)
+                problem = f'check raised {type(e).__name__}'
+                if self.debug:
+                    problem += f': {e}'
+            if problem:
+                problems[name] = problem
+        return {
+            'ready': not problems,
+            'checks': {name: problems.get(name, 'ok')
+                       for name, _ in self.checks},
+            'checked_at': time.time(),
+        }
+
+    def status(self):
+        """Return {ready, checks, checked_at}, re-running stale checks."""
+        if time.monotonic() < self._expires:
+            return self._result
+        with self._lock:
+            # Another thread may have refreshed the result while we waited
+            if time.monotonic() >= self._expires:
+                self._result = self._run()
+                self._expires = time.monotonic() + self.ttl
+        return self._result
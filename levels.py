@@ -0,0 +1,581 @@
+import json
+import logging
+import os
+import re
+import time
+
+from metrics import CACHE_LOOKUPS, phase
+from payloads import Payload, content_hash, encode_json
+from polling import Poller
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Level kinds, named after the API path that serves them
+CHAR_LEVELS = 'levels'
+IDIOM_LEVELS = 'idioms'
+
+# Registry key of the payload that carries every level at once
+BUNDLE = 'bundle'
+
+# Registry keys of the compact v2 format. A v2 character level is
+#   {"syllables": <table version>, "chars": "一乙二", "pinyin": [0, 3, 1]}
+# where pinyin[i] indexes the shared syllable table and belongs to the
+# i-th code point of chars.
+COMPACT_LEVELS = 'v2/levels'
+SYLLABLES = 'v2/syllables'
+COMPACT_BUNDLE = 'v2/bundle'
+
+# Registry key of the content manifest: per-level hashes and sizes that
+# let clients fetch only the levels that changed
+MANIFEST = 'manifest'
+
+# Game modes and the kind of level each one plays
+MODES = {
+    'rotate': CHAR_LEVELS,
+    'pinyin': CHAR_LEVELS,
+    'idiom': IDIOM_LEVELS,
+}
+
+_SOURCE_PATTERN = re.compile(r'^(idiom_)?level(\d+)\.(json|txt)$')
+
+
+def load_char_level(base_dir, level_num):
+    """Load character level data as a {character: pinyin} dict."""
+    json_path = os.path.join(base_dir, f'level{level_num}.json')
+    txt_path = os.path.join(base_dir, f'level{level_num}.txt')
+
+    level_map = {}
+    if os.path.exists(json_path):
+        try:
+            with open(json_path, 'r', encoding='utf-8-sig') as f:
+                data = json.load(f)
+            if isinstance(data, list):
+                for item in data:
+                    ch = item.get('character') or item.get('char')
+                    py = item.get('pinyin') or item.get('py')
+                    if ch and py:
+                        level_map[ch] = py
+            elif isinstance(data, dict):
+                level_map = data
+        except Exception:
+            logger.exception('Error loading level %s', level_num,
+                             extra={'path': json_path})
+    else:
+        logger.warning('Level file not found: %s', json_path)
+
+    if not level_map and os.path.exists(txt_path):
+        try:
+            with open(txt_path, 'r', encoding='utf-8-sig') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    parts = line.split()
+                    if len(parts) >= 2:
+                        level_map[parts[0]] = parts[1]
+        except Exception:
+            pass
+
+    return level_map
+
+
+def load_idiom_level(base_dir, level_num):
+    """Load idiom level data as a list of idiom strings."""
+    json_path = os.path.join(base_dir, f'idiom_level{level_num}.json')
+    txt_path = os.path.join(base_dir, f'idiom_level{level_num}.txt')
+
+    idioms = []
+    if os.path.exists(json_path):
+        try:
+            with open(json_path, 'r', encoding='utf-8-sig') as f:
+                data = json.load(f)
+            if isinstance(data, list):
+                for item in data:
+                    if isinstance(item, str):
+                        idioms.append(item)
+                    elif isinstance(item, dict):
+                        val = item.get('idiom')
+                        if isinstance(val, str):
+                            idioms.append(val)
+        except Exception:
+            pass
+
+    if not idioms and os.path.exists(txt_path):
+        try:
+            with open(txt_path, 'r', encoding='utf-8-sig') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        idioms.append(line)
+        except Exception:
+            pass
+
+    return idioms
+
+
+def source_mtime(base_dir, kind, level_num):
+    """Return the newest mtime of a level's source files, or None."""
+    prefix = 'idiom_level' if kind == IDIOM_LEVELS else 'level'
+    mtimes = []
+    for ext in ('json', 'txt'):
+        try:
+            mtimes.append(os.stat(
+                os.path.join(base_dir, f'{prefix}{level_num}.{ext}')).st_mtime)
+        except OSError:
+            pass
+    return max(mtimes) if mtimes else None
+
+
+_LOADERS = {
+    CHAR_LEVELS: load_char_level,
+    IDIOM_LEVELS: load_idiom_level,
+}
+
+_EMPTY_DATA = {
+    CHAR_LEVELS: dict,
+    IDIOM_LEVELS: list,
+}
+
+_EMPTY = {
+    CHAR_LEVELS: Payload.from_json({}),
+    IDIOM_LEVELS: Payload.from_json([]),
+}
+
+
+def scan_level_sources(base_dir):
+    """Return {kind: sorted level numbers} for the level files in base_dir."""
+    found = {CHAR_LEVELS: set(), IDIOM_LEVELS: set()}
+    for name in os.listdir(base_dir):
+        match = _SOURCE_PATTERN.match(name)
+        if match:
+            kind = IDIOM_LEVELS if match.group(1) else CHAR_LEVELS
+            found[kind].add(int(match.group(2)))
+    return {kind: sorted(nums) for kind, nums in found.items()}
+
+
+def source_signature(base_dir, corpus_path=None):
+    """Return the (name, mtime, size) of every level file, and the corpus.
+
+    Any edit, addition or removal of a level source file, or a rebuilt
+    corpus, changes the signature.
+    """
+    signature = []
+    paths = [os.path.join(base_dir, name) for name in os.listdir(base_dir)
+             if _SOURCE_PATTERN.match(name)]
+    if corpus_path:
+        paths.append(corpus_path)
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def payload_key(kind, level_num):
+    """Return the registry key of a level, e.g. 'levels/3'."""
+    return f'{kind}/{level_num}'
+
+
+class LevelRegistry(object):
+    """Parse-once cache of normalized level data and encoded responses.
+
+    Payloads are keyed by their path under /api/. On first use (or on
+    load()) the registry memory-maps the compiled corpus at corpus_path
+    if there is one, or reads it in one go when mapped is False, and
+    every payload comes precompiled from it; otherwise each level is
+    read from its source files the first time it is requested. Either
+    way the API handlers then only do a dictionary lookup.
+
+    Concurrent misses for the same key are coalesced: one thread builds
+    the payload and the others wait for it, so a cold worker under load
+    parses each level once. A build that fails is not cached; every
+    waiter gets its exception and the next request tries again.
+    """
+
+    def __init__(self, base_dir, corpus_path=None, mapped=True):
+        self.base_dir = base_dir
+        self.corpus_path = corpus_path
+        self.mapped = mapped
+        self.corpus = None
+        self.corpus_version = None
+        self._numbers = None
+        self._data = {}
+        self._payloads = {}
+        self._syllable_table = None
+        self._syllable_index = None
+        self._flight = SingleFlight('levels')
+
+    def load_corpus(self, path):
+        """Replace the registry contents with a compiled level corpus.
+
+        The corpus is memory-mapped (or read whole, if the registry is
+        not mapped); payload bodies are views into it, so no level data
+        is copied per payload.
+        """
+        from corpus import MappedCorpus
+        corpus = MappedCorpus(path, mapped=self.mapped)
+        payloads = {}
+        for key, entry in corpus.entries().items():
+            offset, length, version, last_modified = entry[:4]
+            payloads[key] = Payload(corpus.slice(offset, length),
+                                    last_modified=last_modified,
+                                    version=version,
+                                    gzip_body=corpus.slice(*entry[4:]))
+        self._data = {}
+        self._payloads = payloads
+        self.corpus = corpus
+        self.corpus_version = corpus.version
+        # Last: other threads take a set _numbers to mean loaded
+        self._numbers = {kind: list(nums)
+                         for kind, nums in corpus.header['numbers'].items()}
+
+    def load(self):
+        """Load the corpus (or scan the sources) now instead of on first use."""
+        self._ensure_loaded()
+
+    def source(self):
+        """Return where level data comes from: mapped, read or sources."""
+        self._ensure_loaded()
+        if self.corpus is None:
+            return 'sources'
+        return 'mapped' if self.corpus.mapped else 'read'
+
+    def _ensure_loaded(self):
+        if self._numbers is None:
+            self._flight.do(None, self._load_index)
+
+    def _load_index(self):
+        if self._numbers is not None:
+            return
+        if self.corpus_path and os.path.exists(self.corpus_path):
+            from corpus import CorpusError
+            try:
+                self.load_corpus(self.corpus_path)
+                return
+            except CorpusError as e:
+                logger.warning('Ignoring %s (%s), reading level source files',
+                               self.corpus_path, e)
+        self._numbers = scan_level_sources(self.base_dir)
+
+    def _cached(self, key, build):
+        with phase('lookup'):
+            payload = self._payloads.get(key)
+            if payload is not None:
+                CACHE_LOOKUPS.inc('levels', 'hit')
+                return payload
+            CACHE_LOOKUPS.inc('levels', 'miss')
+            with phase('load'):
+                self._ensure_loaded()
+            return self._flight.do(key, lambda: self._build_once(key, build))
+
+    def _build_once(self, key, build):
+        # Another thread may have built it between our miss and now
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = build()
+        return payload
+
+    def level_numbers(self, kind):
+        """Return the sorted level numbers that have data."""
+        self._ensure_loaded()
+        return self._numbers[kind]
+
+    def data(self, kind, level_num):
+        """Return the normalized dataset for a level."""
+        key = payload_key(kind, level_num)
+        if key not in self._data:
+            self._flight.do(key, lambda: self._load(kind, level_num))
+        return self._data.get(key, _EMPTY_DATA[kind]())
+
+    def payload(self, kind, level_num):
+        """Return the encoded API response for a level."""
+        return self._cached(payload_key(kind, level_num),
+                            lambda: self._load(kind, level_num))
+
+    def bundle(self):
+        """Return one payload holding every character and idiom level.
+
+        Levels are listed in order starting at level 1, so index i of
+        each list holds level i + 1.
+        """
+        return self._cached(BUNDLE, self._build_bundle)
+
+    def syllables(self):
+        """Return the payload of the interned pinyin syllable table.
+
+        The table holds every distinct pinyin across all character
+        levels, sorted, so v2 levels can refer to syllables by index.
+        """
+        return self._cached(SYLLABLES, self._build_syllables)
+
+    def compact(self, level_num):
+        """Return the v2 payload of a character level."""
+        return self._cached(payload_key(COMPACT_LEVELS, level_num),
+                            lambda: self._build_compact(level_num))
+
+    def compact_bundle(self):
+        """Return every level in the v2 format, syllable table included."""
+        return self._cached(COMPACT_BUNDLE, self._build_compact_bundle)
+
+    def all_payloads(self):
+        """Build and return every payload the registry serves, by key."""
+        payloads = {}
+        for kind in (CHAR_LEVELS, IDIOM_LEVELS):
+            for n in self.level_numbers(kind):
+                payloads[payload_key(kind, n)] = self.payload(kind, n)
+        for n in self.level_numbers(CHAR_LEVELS):
+            payloads[payload_key(COMPACT_LEVELS, n)] = self.compact(n)
+        payloads[BUNDLE] = self.bundle()
+        payloads[SYLLABLES] = self.syllables()
+        payloads[COMPACT_BUNDLE] = self.compact_bundle()
+        payloads[MANIFEST] = self.manifest()
+        return payloads
+
+    def manifest(self):
+        """Return the content manifest.
+
+        modes maps each game mode to the kind of level it plays. For each
+        kind, data lists levels 1..count with the URL the client loads
+        the level from and the hash and size of that response; a URL is
+        versioned by appending ?v=<hash>. The manifest version changes
+        whenever any listed payload does.
+        """
+        return self._cached(MANIFEST, self._build_manifest)
+
+    def _build_bundle(self):
+        bundle = {}
+        mtimes = []
+        for kind in (CHAR_LEVELS, IDIOM_LEVELS):
+            numbers = self.level_numbers(kind)
+            last = numbers[-1] if numbers else 0
+            bundle[kind] = [self.data(kind, n) for n in range(1, last + 1)]
+            mtimes.extend(self.payload(kind, n).last_modified
+                          for n in numbers)
+        payload = Payload.from_json(
+            bundle, last_modified=max(filter(None, mtimes), default=None))
+        self._payloads[BUNDLE] = payload
+        return payload
+
+    def _build_syllables(self):
+        table = set()
+        for n in self.level_numbers(CHAR_LEVELS):
+            table.update(self.data(CHAR_LEVELS, n).values())
+        self._syllable_table = sorted(table)
+        self._syllable_index = {
+            py: i for i, py in enumerate(self._syllable_table)}
+        payload = Payload.from_json(self._syllable_table)
+        self._payloads[SYLLABLES] = payload
+        return payload
+
+    def _build_compact(self, level_num):
+        table = self.syllables()
+        if level_num not in self.level_numbers(CHAR_LEVELS):
+            # Like _load, unknown levels are answered but not cached
+            return Payload.from_json(
+                {'chars': '', 'pinyin': [], 'syllables': table.version})
+        compact = self._compact_level(level_num)
+        compact['syllables'] = table.version
+        payload = Payload.from_json(
+            compact,
+            last_modified=self.payload(CHAR_LEVELS, level_num).last_modified)
+        self._payloads[payload_key(COMPACT_LEVELS, level_num)] = payload
+        return payload
+
+    def _build_compact_bundle(self):
+        self.syllables()
+        bundle = {'syllables': self._syllable_table}
+        for kind, build in ((CHAR_LEVELS, self._compact_level),
+                            (IDIOM_LEVELS, self._idiom_level)):
+            numbers = self.level_numbers(kind)
+            last = numbers[-1] if numbers else 0
+            bundle[kind] = [build(n) for n in range(1, last + 1)]
+        # The body names its own version (the hash of the rest of it), so
+        # clients can check what they got behind any host or CDN, whatever
+        # ETag it sends
+        version = content_hash(encode_json(bundle))
+        with phase('serialize'):
+            payload = Payload(encode_json(dict(version=version, **bundle)),
+                              last_modified=self.bundle().last_modified,
+                              version=version)
+        self._payloads[COMPACT_BUNDLE] = payload
+        return payload
+
+    def _build_manifest(self):
+        def describe(key, payload):
+            return {'url': f'/api/{key}', 'hash': payload.version,
+                    'size': len(payload.body)}
+
+        levels = {}
+        for kind, url_kind, get in (
+                (CHAR_LEVELS, COMPACT_LEVELS, self.compact),
+                (IDIOM_LEVELS, IDIOM_LEVELS, self._idiom_payload)):
+            numbers = self.level_numbers(kind)
+            count = numbers[-1] if numbers else 0
+            entries = []
+            for n in range(1, count + 1):
+                entry = describe(payload_key(url_kind, n), get(n))
+                entry['level'] = n
+                entries.append(entry)
+            levels[kind] = {'count': count, 'entries': entries}
+        syllables = describe(SYLLABLES, self.syllables())
+        bundle = describe(COMPACT_BUNDLE, self.compact_bundle())
+        hashes = [syllables['hash'], bundle['hash']]
+        for kind in sorted(levels):
+            hashes.extend(entry['hash'] for entry in levels[kind]['entries'])
+        payload = Payload.from_json({
+            'version': content_hash(' '.join(hashes).encode('ascii')),
+            'modes': MODES,
+            'data': levels,
+            'syllables': syllables,
+            'bundle': bundle,
+        })
+        self._payloads[MANIFEST] = payload
+        return payload
+
+    def _idiom_payload(self, level_num):
+        return self.payload(IDIOM_LEVELS, level_num)
+
+    def _compact_level(self, level_num):
+        self.syllables()
+        data = self.data(CHAR_LEVELS, level_num)
+        index = self._syllable_index
+        return {
+            'chars': ''.join(data),
+            'pinyin': [index[py] for py in data.values()],
+        }
+
+    def _idiom_level(self, level_num):
+        return self.data(IDIOM_LEVELS, level_num)
+
+    def _load(self, kind, level_num):
+        if level_num not in self.level_numbers(kind):
+            # Unknown levels get a shared empty response and are not
+            # cached, so arbitrary level numbers cannot grow the registry
+            return _EMPTY[kind]
+        with phase('parse'):
+            data = _LOADERS[kind](self.base_dir, level_num)
+        payload = Payload.from_json(
+            data, last_modified=source_mtime(self.base_dir, kind, level_num))
+        key = payload_key(kind, level_num)
+        self._data[key] = data
+        self._payloads[key] = payload
+        return payload
+
+
+class LiveRegistry(object):
+    """A LevelRegistry that is rebuilt when level files change.
+
+    Calls are passed to the current snapshot, a complete LevelRegistry.
+    watch() starts a thread that polls the level source files (and the
+    corpus) every interval seconds. When they change and then stay
+    unchanged for one more poll, so half-written files are not picked
+    up, it builds a new snapshot with every payload and its gzip variant
+    and swaps it in with one assignment. A request works on the snapshot
+    it started with, and new content has new ETags.
+
+    The first snapshot, and every rebuilt one, reads the corpus only if
+    it is newer than every source file; otherwise it parses the sources,
+    until compile-levels brings the corpus up to date. Sources are
+    validated first, as by compile-levels: if they have errors, the
+    errors are logged and the current snapshot (or, at startup, the
+    older corpus) is kept until the files change again.
+    """
+
+    def __init__(self, base_dir, corpus_path=None, mapped=True):
+        self.base_dir = base_dir
+        self.corpus_path = corpus_path
+        self.mapped = mapped
+        self._signature = source_signature(base_dir, corpus_path)
+        fresh = self._fresh_corpus(self._signature)
+        if corpus_path and fresh is None and os.path.exists(corpus_path):
+            if self._sources_valid():
+                logger.warning('%s is older than the level files; serving '
+                               'them from source until compile-levels is '
+                               'run', corpus_path)
+            else:
+                fresh = corpus_path
+                logger.error('Serving the older %s until the level files '
+                             'are fixed', corpus_path)
+        self.snapshot = LevelRegistry(base_dir, corpus_path=fresh,
+                                      mapped=mapped)
+        self._pending = None
+        self._rejected = None
+        self._poller = Poller(self.check, 'level-reload',
+                              'Level reload failed; keeping the current '
+                              'level data')
+
+    def __getattr__(self, name):
+        return getattr(self.snapshot, name)
+
+    def watch(self, interval):
+        """Poll for changes every interval seconds, in a daemon thread."""
+        self._poller.start(interval)
+
+    def stop(self):
+        """Stop polling in this process; forked children still poll."""
+        self._poller.stop()
+
+    def check(self):
+        """Swap in rebuilt level data if the files changed and settled.
+
+        Returns True when a new snapshot was swapped in.
+        """
+        signature = source_signature(self.base_dir, self.corpus_path)
+        if signature in (self._signature, self._rejected):
+            self._pending = None
+            return False
+        if signature != self._pending:
+            # Wait one more poll for the files to settle
+            self._pending = signature
+            return False
+        self._pending = None
+        started = time.perf_counter()
+        snapshot = self._build(signature)
+        if snapshot is None:
+            # Not retried until the files change again
+            self._rejected = signature
+            return False
+        # Recorded only once swapped in, so a failed build is retried
+        self.snapshot = snapshot
+        self._signature = signature
+        logger.info('Reloaded level data from %s in %.0f ms (manifest %s)',
+                    snapshot.source(),
+                    (time.perf_counter() - started) * 1000,
+                    snapshot.manifest().version)
+        return True
+
+    def _fresh_corpus(self, signature):
+        """Return corpus_path if it is newer than every source, else None."""
+        if not self.corpus_path:
+            return None
+        corpus = [mtime for path, mtime, _ in signature
+                  if path == self.corpus_path]
+        sources = [mtime for path, mtime, _ in signature
+                   if path != self.corpus_path]
+        if corpus and corpus[0] >= max(sources, default=0):
+            return self.corpus_path
+        return None
+
+    def _build(self, signature):
+        corpus_path = self._fresh_corpus(signature)
+        if corpus_path is None and not self._sources_valid():
+            logger.error('Not reloading level data; keeping the current '
+                         'data until the level files change again')
+            return None
+        snapshot = LevelRegistry(self.base_dir, corpus_path=corpus_path,
+                                 mapped=self.mapped)
+        for payload in snapshot.all_payloads().values():
+            if payload.compressible:
+                payload.gzip_body
+        return snapshot
+
+    def _sources_valid(self):
+        """Validate the level sources; log and return False on errors."""
+        from corpus import validate_sources
+        problems = validate_sources(self.base_dir)
+        for message in problems.errors:
+            logger.error('Level data error: %s', message)
+        return not problems.errors
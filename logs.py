@@ -0,0 +1,141 @@
+"""Structured JSON logging through a background writer.
+
+configure_logging() sends every log record to a bounded in-memory queue;
+a listener thread formats each one as a line of JSON and writes it out.
+Request threads only enqueue, so a slow stdout or log collector never
+adds latency to a response. When the queue is full, records are dropped
+and counted (ccb_log_records_dropped_total) rather than waited on.
+
+Access records of successful requests (2xx and 304) are sampled at
+CCB_LOG_SAMPLE (a fraction, default 0.1); every other status is logged.
+Sampled records carry "sample_rate", so log pipelines can scale counts.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+from metrics import METRICS
+
+QUEUE_SIZE = 10000
+
+# Fraction of successful requests that get an access record
+SAMPLE_RATE = float(os.environ.get('CCB_LOG_SAMPLE', '0.1'))
+
+access_logger = logging.getLogger('access')
+
+LOGS_DROPPED = METRICS.counter(
+    'ccb_log_records_dropped_total',
+    'Log records dropped because the log queue was full.')
+
+# Attributes every LogRecord has; anything else came from extra={...}
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord(
+    '', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as one line of JSON, extra fields included."""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                  time.gmtime(record.created)) +
+                    f'.{int(record.msecs):03d}Z',
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records without blocking, and without formatting them.
+
+    The stock QueueHandler formats the message and traceback in the
+    logging thread so records can cross processes; this queue stays in
+    the process, so that work is left to the listener.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOGS_DROPPED.inc()
+
+    def close(self):
+        # logging.shutdown() closes handlers; drain the queue with it, so
+        # processes that leave through os._exit can still flush
+        flush_logs()
+        super().close()
+
+
+_listener = None
+
+
+def configure_logging(level=None, stream=None):
+    """Route all logging through the JSON background writer."""
+    global _listener
+    if _listener is not None:
+        return
+    level = level or os.environ.get('CCB_LOG_LEVEL', 'INFO').upper()
+    records = queue.Queue(QUEUE_SIZE)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JSONFormatter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _QueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+def flush_logs():
+    """Write out every queued record and stop the writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork():
+    # The writer thread does not survive fork; forked workers start their
+    # own, on a fresh queue
+    global _listener
+    if _listener is not None:
+        stream = _listener.handlers[0].stream
+        _listener = None
+        configure_logging(level=logging.getLogger().level, stream=stream)
+
+
+atexit.register(flush_logs)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def log_access(route, method, path, status, seconds, size=None):
+    """Log one finished request, sampling successful ones."""
+    sampled = 200 <= status < 300 or status == 304
+    if sampled and random.random() >= SAMPLE_RATE:
+        return
+    fields = {'route': route, 'method': method, 'path': path,
+              'status': status, 'duration_ms': round(seconds * 1000, 3),
+              'size': size}
+    if sampled:
+        fields['sample_rate'] = SAMPLE_RATE
+    access_logger.info('%s %s %s', method, path, status, extra=fields)
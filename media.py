@@ -0,0 +1,173 @@
+"""Streamed file responses with HTTP Range support for /assets.
+
+Media elements fetch video and audio in byte ranges so playback can start
+before the whole file has arrived and seeking only downloads what is
+needed. Files are never read into memory: whole files go through the
+server's wsgi.file_wrapper (sendfile where available), ranges are read
+from disk in CHUNK_SIZE blocks.
+"""
+import os
+import uuid
+
+from flask import Response
+from werkzeug.wsgi import wrap_file
+
+ASSET_TYPES = {
+    '.mp4': 'video/mp4',
+    '.wav': 'audio/wav',
+    '.mp3': 'audio/mpeg',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.svg': 'image/svg+xml',
+    '.ttf': 'font/ttf',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+}
+
+CHUNK_SIZE = 256 * 1024
+
+# Requests for more ranges than this get the whole file, so a client cannot
+# make us send the same bytes many times over in one response
+MAX_RANGES = 16
+
+
+def asset_mimetype(filename):
+    """Return the Content-Type for an asset, by extension."""
+    ext = os.path.splitext(filename)[1].lower()
+    return ASSET_TYPES.get(ext, 'application/octet-stream')
+
+
+def resolve_ranges(ranges, size):
+    """Turn parsed Range specs into sorted, merged (start, stop) spans.
+
+    Suffix ranges (bytes=-500) count from the end, open ranges run to the
+    end of the file, and spans starting past the end are dropped. An
+    empty result means the request is unsatisfiable.
+    """
+    spans = []
+    for begin, end in ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size
+        else:
+            start, stop = begin, size if end is None else min(end, size)
+        if start < stop:
+            spans.append((start, stop))
+    spans.sort()
+    merged = []
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _content_range(start, stop, size):
+    return f'bytes {start}-{stop - 1}/{size}'
+
+
+def _read_span(f, start, stop):
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = f.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _stream_spans(path, parts):
+    """Yield each (prefix, start, stop) part: prefix, then file bytes."""
+    with open(path, 'rb') as f:
+        for prefix, start, stop in parts:
+            if prefix:
+                yield prefix
+            if start is not None:
+                for chunk in _read_span(f, start, stop):
+                    yield chunk
+
+
+def file_etag(stat):
+    """Return the ETag of a file on disk, from its mtime and size."""
+    return f'{int(stat.st_mtime * 1000):x}-{stat.st_size:x}'
+
+
+def if_range_matches(if_range, etag, mtime):
+    """Return True unless If-Range names an older copy of the file."""
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(mtime) <= if_range.date.timestamp()
+    return True
+
+
+def send_asset(request, path, mimetype):
+    """Build a streamed response for the file at path, honouring Range.
+
+    Returns None if path is not a regular file. Conditional requests get
+    a 304; satisfiable Range requests get a 206 with one range or a
+    multipart/byteranges body; unsatisfiable ones get a 416.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    size = stat.st_size
+    etag = file_etag(stat)
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    spans = None
+    byte_range = request.range
+    if (byte_range is not None and byte_range.units == 'bytes' and
+            len(byte_range.ranges) <= MAX_RANGES and
+            if_range_matches(request.if_range, etag, stat.st_mtime)):
+        spans = resolve_ranges(byte_range.ranges, size)
+        if not spans:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if spans is None:
+        f = open(path, 'rb')
+        response = Response(wrap_file(request.environ, f, CHUNK_SIZE),
+                            mimetype=mimetype, direct_passthrough=True)
+        response.content_length = size
+    elif len(spans) == 1:
+        start, stop = spans[0]
+        response = Response(_stream_spans(path, [(None, start, stop)]),
+                            status=206, mimetype=mimetype,
+                            direct_passthrough=True)
+        response.headers['Content-Range'] = _content_range(start, stop,
+                                                            size)
+        response.content_length = stop - start
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, stop in spans:
+            prefix = (f'\r\n--{boundary}\r\n'
+                      f'Content-Type: {mimetype}\r\n'
+                      f'Content-Range: {_content_range(start, stop, size)}'
+                      f'\r\n\r\n').encode('ascii')
+            parts.append((prefix, start, stop))
+        parts.append((f'\r\n--{boundary}--\r\n'.encode('ascii'), None, None))
+        length = sum(len(prefix) + (stop - start if start is not None else 0)
+                     for prefix, start, stop in parts)
+        response = Response(_stream_spans(path, parts), status=206,
+                            direct_passthrough=True)
+        response.headers['Content-Type'] = (
+            f'multipart/byteranges; boundary={boundary}')
+        response.content_length = length
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    return response
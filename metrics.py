@@ -0,0 +1,323 @@
+"""In-process metrics in Prometheus text format, and request phase timing.
+
+Counters and histograms are kept per thread, so recording a value takes
+no lock; a scrape of /metrics merges the per-thread values. Every process
+keeps its own metrics: behind the prefork server (python app.py serve) a
+scrape reports the worker that answered it, which ccb_worker_info names.
+
+Request phases are timed for the Server-Timing header (CCB_SERVER_TIMING).
+Code wraps its work in `with phase('parse'):`; that records into the
+timer of the current request if one was started on this thread, and
+costs one thread-local lookup otherwise. Phase times are exclusive: time
+spent in a nested phase is not counted again in the enclosing one.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Request phases reported in Server-Timing, in this order
+PHASES = ('lookup', 'load', 'parse', 'serialize', 'send')
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(object):
+    """A monotonically increasing count per label combination."""
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def inc(self, *labels, amount=1):
+        shard = self.registry._shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, into, values):
+        return (into or 0) + values
+
+    def _render(self, series):
+        for labels, value in sorted(series.items()):
+            yield f'{self.name}{_labels(self.labels, labels)} {value}'
+
+
+class Histogram(object):
+    """Observations counted into cumulative buckets, with their sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels, buckets):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self.registry._shard()
+        key = (self.name, labels)
+        values = shard.get(key)
+        if values is None:
+            # One count per bucket, one for +Inf, then the sum
+            values = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def _merge(self, into, values):
+        if into is None:
+            return list(values)
+        return [a + b for a, b in zip(into, values)]
+
+    def _render(self, series):
+        for labels, values in sorted(series.items()):
+            count = 0
+            for bound, n in zip(self.buckets + ('+Inf',), values):
+                count += n
+                le = f'le="{bound}"'
+                yield (f'{self.name}_bucket'
+                       f'{_labels(self.labels, labels, le)} {count}')
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {values[-1]}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {count}'
+
+
+class Gauge(object):
+    """A value computed at scrape time by a function."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = labels if labels is not None else {}
+
+    def _render(self, series):
+        yield (f'{self.name}{_labels(self.labels, self.labels.values())} '
+               f'{self.function()}')
+
+
+class Metrics(object):
+    """A registry of metrics with lock-free, per-thread recording.
+
+    Each thread records into its own dict, created on its first use. A
+    scrape merges the dicts of every thread; those of threads that have
+    exited are folded into one retired dict, so thread-per-request
+    servers do not accumulate them.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = {}
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, tuple(labels)))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, help, tuple(labels), buckets))
+
+    def gauge(self, name, help, function, labels=None):
+        return self._add(Gauge(name, help, function, labels))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold_exited()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _fold_exited(self):
+        """Merge the dicts of exited threads into the retired dict."""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge_into(self._retired, shard)
+        self._shards = alive
+
+    def _merge_into(self, merged, shard):
+        kinds = {metric.name: metric for metric in self._metrics}
+        # A copy, since the owning thread may add keys while we read
+        for key, values in list(shard.items()):
+            merged[key] = kinds[key[0]]._merge(merged.get(key), values)
+
+    def render(self):
+        """Return every metric in Prometheus text format, as bytes."""
+        with self._lock:
+            self._fold_exited()
+            merged = {}
+            self._merge_into(merged, self._retired)
+            for _, shard in self._shards:
+                self._merge_into(merged, shard)
+        series = {}
+        for (name, labels), values in merged.items():
+            series.setdefault(name, {})[labels] = values
+
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric._render(series.get(metric.name, {})))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def reset(self):
+        """Drop every recorded value, e.g. in a freshly forked worker."""
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = {}
+
+
+# The process-wide registry and the metrics the app records
+METRICS = Metrics()
+
+REQUESTS = METRICS.counter(
+    'ccb_http_requests_total', 'HTTP requests by route and status.',
+    ('route', 'method', 'status'))
+REQUEST_DURATION = METRICS.histogram(
+    'ccb_http_request_duration_seconds',
+    'Time to build each response, by route.', ('route',))
+RESPONSE_SIZE = METRICS.histogram(
+    'ccb_http_response_size_bytes', 'Response body sizes, by route.',
+    ('route',), buckets=SIZE_BUCKETS)
+PHASE_DURATION = METRICS.histogram(
+    'ccb_http_request_phase_seconds',
+    'Time spent in each request phase, by route (with CCB_SERVER_TIMING).',
+    ('route', 'phase'))
+CACHE_LOOKUPS = METRICS.counter(
+    'ccb_cache_lookups_total',
+    'Level data, static file and page cache lookups by result.',
+    ('cache', 'result'))
+
+STARTED = time.time()
+_WORKER = {'pid': os.getpid()}
+METRICS.gauge('ccb_process_start_time_seconds',
+              'Start time of this worker, in seconds since the epoch.',
+              lambda: STARTED)
+METRICS.gauge('ccb_process_uptime_seconds', 'Seconds this worker has run.',
+              lambda: round(time.time() - STARTED, 3))
+METRICS.gauge('ccb_worker_info', 'The worker process that answered.',
+              lambda: 1, labels=_WORKER)
+
+
+def _after_fork():
+    # Workers forked by the prefork server start their own counts, and
+    # must not report what the parent recorded while preloading
+    global STARTED
+    STARTED = time.time()
+    _WORKER['pid'] = os.getpid()
+    METRICS.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def record_request(route, method, status, seconds, size=None, timer=None):
+    """Record one finished request, and its phase times if timed."""
+    REQUESTS.inc(route, method, str(status))
+    REQUEST_DURATION.observe(seconds, route)
+    if size is not None:
+        RESPONSE_SIZE.observe(size, route)
+    if timer is not None:
+        for name, duration in timer.durations.items():
+            PHASE_DURATION.observe(duration, route, name)
+
+
+class RequestTimer(object):
+    """Exclusive time spent in each phase of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}
+        self._stack = []
+
+    def enter(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def exit(self):
+        name, started, nested = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        self.durations[name] = self.durations.get(name, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def server_timing(self):
+        """Return the Server-Timing header value, durations in ms."""
+        total = time.perf_counter() - self.started
+        parts = [f'{name};dur={self.durations[name] * 1000:.3f}'
+                 for name in PHASES if name in self.durations]
+        parts.append(f'total;dur={total * 1000:.3f}')
+        return ', '.join(parts)
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.timer.exit()
+
+
+_current = threading.local()
+_NO_PHASE = nullcontext()
+
+
+def phase(name):
+    """Context manager timing a phase of the current request, if timed."""
+    timer = getattr(_current, 'timer', None)
+    if timer is None:
+        return _NO_PHASE
+    return _Phase(timer, name)
+
+
+def start_timer():
+    """Start timing the phases of a request handled on this thread."""
+    timer = _current.timer = RequestTimer()
+    return timer
+
+
+def stop_timer():
+    """Stop timing on this thread; return the timer, or None."""
+    timer = getattr(_current, 'timer', None)
+    _current.timer = None
+    return timer
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import zlib
+
+from werkzeug.http import (http_date, parse_accept_header, parse_date,
+                           parse_etags, quote_etag)
+from werkzeug.utils import get_content_type
+
+from metrics import phase
+from singleflight import SingleFlight
+
+
+def encode_json(data):
+    """Serialize data to the compact UTF-8 JSON bytes we send to clients."""
+    return json.dumps(data, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def gzip_compress(body):
+    """Gzip body at maximum compression with a fixed header timestamp."""
+    # wbits=31 selects the gzip container; zlib leaves the mtime field
+    # zeroed, so the output only depends on the input bytes
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+# Bodies smaller than this are sent as-is; gzip framing would eat the gain
+MIN_COMPRESS_SIZE = 256
+
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+])
+
+
+def is_compressible(mimetype, size):
+    """Return True if a body of this type and size is worth gzipping."""
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+def content_hash(body):
+    """Return the hex digest used to version and validate a body."""
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+# Concurrent first requests for a payload's gzip body share one compression
+_compressions = SingleFlight('gzip')
+
+
+class Payload(object):
+    """A response body that is encoded once and served many times.
+
+    version is a hash of the body (of the rest of it, for a body that
+    names its own version); it doubles as the strong ETag and as
+    the ?v= query value of versioned URLs. last_modified is a Unix
+    timestamp of the newest source the body was built from, if known.
+    Compressible payloads keep a gzip copy of the body so compression
+    is paid once per process rather than once per request. Bodies may be
+    bytes or memoryview slices of a mapped corpus.
+    """
+
+    __slots__ = ('body', 'mimetype', 'version', 'last_modified',
+                 'compressible', '_gzip_body')
+
+    def __init__(self, body, mimetype='application/json',
+                 last_modified=None, version=None, gzip_body=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.version = version or content_hash(body)
+        self.last_modified = last_modified
+        self.compressible = is_compressible(mimetype, len(body))
+        self._gzip_body = gzip_body
+
+    def etag(self, gzip=False):
+        """Return the unquoted strong ETag of the plain or gzip body."""
+        # A different encoding is a different representation, so it
+        # needs its own strong validator
+        return f'{self.version}-gzip' if gzip else self.version
+
+    @property
+    def gzip_body(self):
+        """The body gzip-compressed, computed once on first use."""
+        if self._gzip_body is None:
+            # Keyed by identity: the payload is alive while compressing
+            self._gzip_body = _compressions.do(id(self), self._compress)
+        return self._gzip_body
+
+    def _compress(self):
+        if self._gzip_body is None:
+            return gzip_compress(self.body)
+        return self._gzip_body
+
+    @classmethod
+    def from_json(cls, data, last_modified=None):
+        with phase('serialize'):
+            return cls(encode_json(data), last_modified=last_modified)
+
+
+# Cache-Control for URLs that name the payload version (?v=<hash> or a
+# fingerprinted file name): the content behind them never changes
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+# Cache-Control for everything else: reuse the cached copy only after
+# revalidating it with the ETag
+CACHE_REVALIDATE = 'no-cache'
+
+
+def negotiate(payload, accept_encoding=None, if_none_match=None,
+              if_modified_since=None, version=None, immutable=None):
+    """Choose the response for a payload from raw request header values.
+
+    Returns (status, headers, body) with headers as a list of (name,
+    value) pairs, so any server stack can send it. Requests whose
+    validators match get a bodiless 304. Compressible payloads are sent
+    as their cached gzip body to clients that accept it. The response is
+    cached as immutable if version (the ?v= query value) is the
+    payload's version, or if the caller passes immutable=True because
+    the path names it.
+    """
+    use_gzip = (payload.compressible and
+                parse_accept_header(accept_encoding)['gzip'] > 0)
+    etag = payload.etag(gzip=use_gzip)
+
+    if immutable is None:
+        immutable = version == payload.version
+
+    if if_none_match:
+        # If-None-Match uses weak comparison (RFC 9110 13.1.2), so a
+        # W/"..." echoed back by a proxy or CDN still matches
+        not_modified = parse_etags(if_none_match).contains_weak(etag)
+    elif if_modified_since and payload.last_modified:
+        since = parse_date(if_modified_since)
+        not_modified = (since is not None and
+                        int(payload.last_modified) <= since.timestamp())
+    else:
+        not_modified = False
+
+    headers = []
+    if not_modified:
+        status, body = 304, b''
+    else:
+        # Servers only accept bytes, so bodies that are views of the
+        # mapped level corpus are copied out here, once per response
+        status = 200
+        body = bytes(payload.gzip_body if use_gzip else payload.body)
+        headers.append(('Content-Type',
+                        get_content_type(payload.mimetype, 'utf-8')))
+        if use_gzip:
+            headers.append(('Content-Encoding', 'gzip'))
+    headers.append(('ETag', quote_etag(etag)))
+    headers.append(('Cache-Control',
+                    CACHE_IMMUTABLE if immutable else CACHE_REVALIDATE))
+    if payload.last_modified and not not_modified:
+        headers.append(('Last-Modified',
+                        http_date(int(payload.last_modified))))
+    if payload.compressible:
+        headers.append(('Vary', 'Accept-Encoding'))
+    return status, headers, body
@@ -0,0 +1,54 @@
+"""Background polling that survives fork.
+
+A Poller calls a function every interval seconds on a daemon thread. The
+level registry and the static file table use one each to pick up edited
+files. Threads do not survive fork, so a started poller starts a fresh
+thread in every forked child; stop() ends polling in the current process
+only, which lets the prefork server's parent stay idle while each worker
+polls on its own.
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Poller(object):
+    """Calls function every interval seconds, in each process."""
+
+    def __init__(self, function, name, failure):
+        self.function = function
+        self.name = name
+        # Logged, with the traceback, when function raises
+        self.failure = failure
+        self.interval = None
+        self._thread = None
+
+    def start(self, interval):
+        """Poll every interval seconds, here and in forked children."""
+        first = self.interval is None
+        self.interval = interval
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=self.name)
+        self._thread.start()
+        if first and hasattr(os, 'register_at_fork'):
+            os.register_at_fork(
+                after_in_child=lambda: self.start(self.interval))
+
+    def stop(self):
+        """Stop polling in this process; forked children still poll."""
+        self._thread = None
+
+    def _run(self):
+        thread = self._thread
+        while True:
+            time.sleep(self.interval)
+            # A stopped or restarted poller has a different thread
+            if thread is not self._thread:
+                return
+            try:
+                self.function()
+            except Exception:
+                logger.exception(self.failure)
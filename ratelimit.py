@@ -0,0 +1,190 @@
+"""Token-bucket rate limiting per client address and route class.
+
+Each (client, route class) pair has a bucket that holds up to burst
+tokens and refills at rate tokens per second; a request takes a token or
+is refused with the number of seconds until one is available. Rules come
+from CCB_RATE_LIMIT, e.g.
+
+    CCB_RATE_LIMIT="api=20:100,static=10:50"
+
+gives /api/ routes 20 requests per second with bursts of 100, and pages
+and static files 10 per second with bursts of 50. Route classes without
+a rule are not limited.
+
+Buckets live in a backend:
+
+    MemoryBackend  in-process, per worker; a fixed number of lock stripes
+                   each hold an LRU of buckets, so memory is bounded and
+                   threads only contend when their keys share a stripe
+    SQLiteBackend  a SQLite file shared by every worker on the host
+                   (CCB_RATE_LIMIT_BACKEND=sqlite:/path/to/file.db)
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED = METRICS.counter(
+    'ccb_rate_limited_total', 'Requests refused by the rate limiter.',
+    ('route_class',))
+
+
+def parse_rules(spec):
+    """Parse 'class=rate:burst,...' into {class: (rate, burst)}."""
+    rules = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            name, limits = item.split('=')
+            rate, burst = limits.split(':')
+            rate, burst = float(rate), float(burst)
+        except ValueError:
+            raise ValueError(f'bad rate limit {item!r}; expected '
+                             f'class=rate:burst')
+        if rate <= 0 or burst < 1:
+            raise ValueError(f'bad rate limit {item!r}; rate must be '
+                             f'positive and burst at least 1')
+        rules[name.strip()] = (rate, burst)
+    return rules
+
+
+def take_token(tokens, updated, rate, burst, now):
+    """Refill a bucket and take a token; return (tokens, seconds to wait).
+
+    A wait of 0 means the token was taken. tokens is None for a new
+    bucket, which starts full.
+    """
+    if tokens is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend(object):
+    """Buckets in this process, in lock-striped LRU dicts."""
+
+    # Exceptions of a failing backend, which RateLimiter lets through
+    errors = ()
+
+    def __init__(self, max_buckets=10000, stripes=16):
+        self._stripes = [(threading.Lock(), OrderedDict())
+                         for _ in range(stripes)]
+        self._per_stripe = max(1, max_buckets // stripes)
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        lock, buckets = self._stripes[hash(key) % len(self._stripes)]
+        with lock:
+            tokens, updated = buckets.pop(key, (None, now))
+            tokens, wait = take_token(tokens, updated, rate, burst, now)
+            # Reinserted last, so the least recently used bucket is first
+            buckets[key] = (tokens, now)
+            if len(buckets) > self._per_stripe:
+                buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteBackend(object):
+    """Buckets in a SQLite file, shared by the processes that open it.
+
+    Each thread has its own connection. A bucket's row records when it
+    will be full again; past that it is the same as a missing row, so
+    such rows are pruned every prune_every takes.
+    """
+
+    def __init__(self, path, prune_every=1000):
+        # Imported here, so apps without a SQLite backend never load it
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.errors = (sqlite3.Error,)
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        # A connection of its own, closed again: connections must not be
+        # inherited by forked workers
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, '
+                'tokens REAL, updated REAL, full_at REAL)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Autocommit mode; take() manages its own transactions
+        conn = self._sqlite3.connect(self.path, timeout=1.0,
+                                     isolation_level=None)
+        conn.execute('PRAGMA synchronous=OFF')
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._local.takes = 0
+        return conn
+
+    def take(self, key, rate, burst):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets '
+                               'WHERE key = ?', (key,)).fetchone()
+            tokens, wait = take_token(row and row[0], row and row[1],
+                                      rate, burst, now)
+            conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)',
+                         (key, tokens, now, now + (burst - tokens) / rate))
+            self._local.takes += 1
+            if self._local.takes % self.prune_every == 0:
+                conn.execute('DELETE FROM buckets WHERE full_at < ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+def make_backend(spec):
+    """Return the backend named by CCB_RATE_LIMIT_BACKEND."""
+    if not spec or spec == 'memory':
+        return MemoryBackend()
+    if spec.startswith('sqlite:'):
+        return SQLiteBackend(spec[len('sqlite:'):])
+    raise ValueError(f'unknown rate limit backend {spec!r}; expected '
+                     f'memory or sqlite:<path>')
+
+
+class RateLimiter(object):
+    """Applies rules of {route class: (rate, burst)} using a backend."""
+
+    def __init__(self, rules, backend=None):
+        self.rules = rules
+        self.backend = backend if backend is not None else MemoryBackend()
+
+    def check(self, client, route_class):
+        """Take a token; return None, or seconds until the client may retry.
+
+        A backend that fails (a locked or unwritable SQLite file) lets
+        the request through rather than refusing service.
+        """
+        rule = self.rules.get(route_class)
+        if rule is None:
+            return None
+        try:
+            wait = self.backend.take(f'{route_class}|{client}', *rule)
+        except self.backend.errors:
+            logger.warning('Rate limit backend failed; allowing request',
+                           exc_info=True)
+            return None
+        if not wait:
+            return None
+        RATE_LIMITED.inc(route_class)
+        return wait
@@ -0,0 +1,266 @@
+"""Prefork WSGI server for self-hosting (python app.py serve).
+
+The parent process binds the listening socket, preloads the app's data
+and then forks the workers, so the mapped level corpus and every
+pre-encoded payload are shared copy-on-write between them. Each worker
+accepts connections from the shared socket and handles them on a fixed
+pool of threads.
+
+Signals to the parent:
+
+    SIGTERM, SIGINT  stop; workers finish in-flight requests, then exit
+    SIGHUP           start fresh workers, then retire the old ones
+
+A worker that has handled max_requests requests (plus a random share of
+max_requests_jitter, so workers do not all recycle together) stops
+accepting, finishes what it has and is replaced.
+
+Without os.fork (Windows) the server runs in the current process and
+max_requests is ignored.
+"""
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# Connections that send nothing for this many seconds are closed, so slow
+# clients cannot hold pool threads forever
+REQUEST_TIMEOUT = 15
+
+# Seconds workers get to finish in-flight requests when stopping
+GRACEFUL_TIMEOUT = 30
+
+LISTEN_BACKLOG = 1024
+
+logger = logging.getLogger(__name__)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # Werkzeug's handler answers every request with Connection: close, so
+    # each connection carries one request
+    timeout = REQUEST_TIMEOUT
+
+    def log_request(self, code='-', size='-'):
+        # The app writes its own (sampled) access log
+        pass
+
+    def run_wsgi(self):
+        try:
+            super().run_wsgi()
+        finally:
+            self.server.request_done()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server on an already bound socket, with a fixed thread pool."""
+
+    multithread = True
+
+    def __init__(self, sock, app, threads, max_requests=0,
+                 multiprocess=False):
+        host, port = sock.getsockname()[:2]
+        self.multiprocess = multiprocess
+        super().__init__(host, port, app, handler=_RequestHandler,
+                         fd=sock.fileno())
+        # Workers race for each connection; the losers must not block
+        self.socket.setblocking(False)
+        self.max_requests = max_requests
+        self._pool = ThreadPoolExecutor(threads)
+        self._handled = 0
+        self._count_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def get_request(self):
+        conn, addr = self.socket.accept()
+        conn.setblocking(True)
+        return conn, addr
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def request_done(self):
+        """Count a handled request, stopping after max_requests."""
+        if self.max_requests:
+            with self._count_lock:
+                self._handled += 1
+                recycle = self._handled >= self.max_requests
+            if recycle:
+                self.stop()
+
+    def stop(self):
+        """Stop accepting connections; serve() returns once drained."""
+        if not self._stopping.is_set():
+            self._stopping.set()
+            # shutdown() waits for serve_forever(), so it cannot run on
+            # the serving thread (signal handlers run there)
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def serve(self):
+        """Serve until stop(), then wait for in-flight requests."""
+        self.serve_forever()
+        self._pool.shutdown(wait=True)
+
+
+class Arbiter(object):
+    """Parent process: forks, watches, recycles and stops the workers."""
+
+    def __init__(self, app, sock, workers, threads, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=GRACEFUL_TIMEOUT):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self._children = {}
+        self._generation = 0
+        self._signals = []
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._on_signal)
+        while True:
+            self._reap()
+            signals, self._signals = self._signals, []
+            if signal.SIGTERM in signals or signal.SIGINT in signals:
+                break
+            if signal.SIGHUP in signals:
+                self._reload()
+            self._spawn_missing()
+            time.sleep(0.5)
+        self._stop()
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _spawn_missing(self):
+        current = [pid for pid, generation in self._children.items()
+                   if generation == self._generation]
+        for _ in range(self.workers - len(current)):
+            self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = self._generation
+            return
+        status = 1
+        try:
+            self._run_worker()
+            status = 0
+        except BaseException:
+            logger.exception('Worker %s failed', os.getpid())
+        finally:
+            # os._exit skips atexit, so flush logging by hand
+            logging.shutdown()
+            sys.stdout.flush()
+            os._exit(status)
+
+    def _run_worker(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        max_requests = self.max_requests
+        if max_requests:
+            random.seed()
+            max_requests += random.randint(0, self.max_requests_jitter)
+        server = PooledWSGIServer(self.sock, self.app, self.threads,
+                                  max_requests=max_requests,
+                                  multiprocess=True)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: server.stop())
+        server.serve()
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if not pid:
+                return
+            self._children.pop(pid, None)
+            if status:
+                logger.warning('Worker %s exited with status %s', pid,
+                               status)
+
+    def _reload(self):
+        """Start a new generation of workers, then retire the old one."""
+        old = list(self._children)
+        self._generation += 1
+        self._spawn_missing()
+        self._kill(old, signal.SIGTERM)
+
+    def _kill(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _stop(self):
+        self._kill(list(self._children), signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self._children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        self._kill(list(self._children), signal.SIGKILL)
+        self._reap()
+
+
+def bind_socket(host, port):
+    """Return a listening TCP socket for host and port."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+def serve(app, host='127.0.0.1', port=5000, workers=1, threads=8,
+          max_requests=0, max_requests_jitter=0, preload=None):
+    """Run app on host:port with forked workers until stopped.
+
+    preload is called in the parent after the socket is bound and before
+    any worker is forked.
+    """
+    sock = bind_socket(host, port)
+    if preload is not None:
+        preload()
+    # Keep the preloaded objects out of the collector's reach, so a GC run
+    # in a worker does not write to (and so copy) the shared pages
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    if not hasattr(os, 'fork'):
+        logger.warning('os.fork is not available; serving from a single '
+                       'process')
+        workers = 0
+    logger.info('Serving on http://%s:%s with %s workers x %s threads',
+                host, sock.getsockname()[1], max(workers, 1), threads)
+    if not workers:
+        server = PooledWSGIServer(sock, app, threads)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+        server.serve()
+        return 0
+    Arbiter(app, sock, workers, threads, max_requests=max_requests,
+            max_requests_jitter=max_requests_jitter).run()
+    return 0
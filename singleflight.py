@@ -0,0 +1,70 @@
+"""Coalescing of concurrent calls that compute the same thing.
+
+When many threads miss a cache for the same key at once (a new worker
+under load, a fresh snapshot after a deploy), SingleFlight lets the first
+one compute the value while the others wait for its result instead of
+repeating the work. Nothing is cached here: once the call finishes the
+key is forgotten, so a failure is raised to everyone waiting on that call
+and the next call tries again.
+"""
+import threading
+
+from metrics import METRICS
+
+COALESCED = METRICS.counter(
+    'ccb_coalesced_calls_total',
+    'Calls that waited for a concurrent identical call instead of '
+    'computing.', ('flight',))
+
+
+class _Call(object):
+    __slots__ = ('owner', 'done', 'result', 'error')
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time; others share its outcome."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """Return function(), or the result of a call already running for key.
+
+        A thread that re-enters do() for a key it is itself computing
+        runs function directly rather than waiting on itself.
+        """
+        me = threading.get_ident()
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call(me)
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            if call.owner == me:
+                return function()
+            COALESCED.inc(self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
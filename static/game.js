@@ -5,6 +5,136 @@ const Mode = {
     IDIOM: 2
 };
 
+// A character level is a pair of parallel arrays: chars[i] is read pinyin[i]
+const EMPTY_CHAR_LEVEL = { chars: [], pinyin: [] };
+
+// Local cache key of the last level manifest the client applied
+const MANIFEST_CACHE_KEY = 'manifest';
+
+async function fetchJSON(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status} for ${url}`);
+    }
+    return response.json();
+}
+
+// Fetch and decode a v2 level bundle; version is the content hash the
+// bundle carries in its body, so it holds behind any host or CDN
+async function fetchBundle(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status} for ${url}`);
+    }
+    const bundle = await response.json();
+    return {
+        version: bundle.version,
+        charLevels: bundle.levels.map(
+            level => decodeCompactLevel(level, bundle.syllables)),
+        idiomLevels: bundle.idioms
+    };
+}
+
+// Every level a manifest lists, character levels first, tagged with kind
+function manifestEntries(manifest) {
+    const entries = [];
+    for (const kind of ['levels', 'idioms']) {
+        for (const entry of manifest.data[kind].entries) {
+            entries.push(Object.assign({ kind: kind }, entry));
+        }
+    }
+    return entries;
+}
+
+// Level payloads stored in IndexedDB under their content hash, so a level
+// is only downloaded again when its hash changes. Every method degrades
+// to a no-op cache when IndexedDB is unavailable (e.g. private browsing).
+class LevelCache {
+    constructor() {
+        this.dbPromise = null;
+    }
+
+    open() {
+        if (!this.dbPromise) {
+            this.dbPromise = new Promise(resolve => {
+                if (!('indexedDB' in window)) {
+                    resolve(null);
+                    return;
+                }
+                const request = indexedDB.open('ccb-level-cache', 1);
+                request.onupgradeneeded = () => {
+                    request.result.createObjectStore('payloads');
+                };
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => resolve(null);
+            });
+        }
+        return this.dbPromise;
+    }
+
+    async get(key) {
+        const db = await this.open();
+        if (!db) {
+            return undefined;
+        }
+        return new Promise(resolve => {
+            const request = db.transaction('payloads')
+                .objectStore('payloads').get(key);
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => resolve(undefined);
+        });
+    }
+
+    async put(entries) {
+        const db = await this.open();
+        if (!db || entries.length === 0) {
+            return;
+        }
+        return new Promise(resolve => {
+            const tx = db.transaction('payloads', 'readwrite');
+            const store = tx.objectStore('payloads');
+            for (const [key, value] of entries) {
+                store.put(value, key);
+            }
+            tx.oncomplete = () => resolve();
+            tx.onerror = () => resolve();
+            tx.onabort = () => resolve();
+        });
+    }
+
+    async retain(keys) {
+        // Drop everything not listed, so old level versions do not pile up
+        const db = await this.open();
+        if (!db) {
+            return;
+        }
+        const keep = new Set(keys);
+        return new Promise(resolve => {
+            const tx = db.transaction('payloads', 'readwrite');
+            const store = tx.objectStore('payloads');
+            const request = store.getAllKeys();
+            request.onsuccess = () => {
+                for (const key of request.result) {
+                    if (!keep.has(key)) {
+                        store.delete(key);
+                    }
+                }
+            };
+            tx.oncomplete = () => resolve();
+            tx.onerror = () => resolve();
+            tx.onabort = () => resolve();
+        });
+    }
+}
+
+// Decode a compact v2 level ({chars: string, pinyin: syllable indexes})
+function decodeCompactLevel(level, syllables) {
+    return {
+        chars: Array.from(level.chars),
+        pinyin: level.pinyin.map(i => syllables[i])
+    };
+}
+
 // Utility function to strip tone marks from pinyin
 function stripToneMarks(text) {
     const toneMap = {
@@ -325,6 +455,8 @@ class Game {
 
         this.charLevels = [];
         this.idiomLevels = [];
+        this.levelCounts = { levels: 0, idioms: 0 };
+        this.levelCache = new LevelCache();
         this.usedChars = new Set();
         this.usedIdioms = new Set();
 
@@ -490,48 +622,128 @@ class Game {
     }
 
     async loadLevelData() {
-        this.charLevels = [];
-        this.idiomLevels = [];
-        // Load character levels
-        for (let i = 1; i <= 14; i++) {
+        // Start instantly from local data when everything the last
+        // manifest listed is still cached, then check for updates
+        const cached = await this.levelCache.get(MANIFEST_CACHE_KEY);
+        if (cached && await this.applyManifest(cached, false)) {
+            console.log(`Loaded level data ${cached.version} from local cache`);
+            this.refreshLevelData(cached.version);
+            return;
+        }
+        await this.refreshLevelData(null);
+    }
+
+    async refreshLevelData(currentVersion) {
+        let manifest;
+        try {
+            manifest = await fetchJSON('/api/manifest');
+        } catch (e) {
+            if (currentVersion !== null) {
+                return; // Offline: keep playing with the cached data
+            }
+            console.warn('Manifest unavailable, loading the level bundle:', e);
             try {
-                const response = await fetch(`/api/levels/${i}`);
-                if (!response.ok) {
-                    console.warn(`Failed to load level ${i}: ${response.status}`);
-                    this.charLevels.push({});
-                    continue;
-                }
-                const data = await response.json();
-                this.charLevels.push(data);
-                if (Object.keys(data).length > 0) {
-                    console.log(`Loaded level ${i} with ${Object.keys(data).length} characters`);
-                }
-            } catch (e) {
-                console.error(`Error loading level ${i}:`, e);
-                this.charLevels.push({});
+                const bundle = await fetchBundle('/api/v2/bundle');
+                this.applyLevels(bundle.charLevels, bundle.idiomLevels);
+            } catch (bundleError) {
+                console.error('Error loading level data:', bundleError);
             }
+            return;
         }
-        // Load idiom levels
-        for (let i = 1; i <= 6; i++) {
-            try {
-                const response = await fetch(`/api/idioms/${i}`);
-                if (!response.ok) {
-                    console.warn(`Failed to load idiom level ${i}: ${response.status}`);
-                    this.idiomLevels.push([]);
-                    continue;
-                }
-                const data = await response.json();
-                this.idiomLevels.push(data);
-                if (data.length > 0) {
-                    console.log(`Loaded idiom level ${i} with ${data.length} idioms. ` +
-                        `First idiom: ${data[0]}`);
-                }
-            } catch (e) {
-                console.error(`Error loading idiom level ${i}:`, e);
-                this.idiomLevels.push([]);
+        if (manifest.version === currentVersion) {
+            return;
+        }
+        try {
+            await this.applyManifest(manifest, true);
+        } catch (e) {
+            console.error('Error loading level data:', e);
+            return;
+        }
+        const keep = manifestEntries(manifest).map(entry => entry.hash);
+        keep.push(manifest.syllables.hash, MANIFEST_CACHE_KEY);
+        await this.levelCache.put([[MANIFEST_CACHE_KEY, manifest]]);
+        await this.levelCache.retain(keep);
+        console.log(`Level data ${manifest.version} ready`);
+    }
+
+    async applyManifest(manifest, fetchMissing) {
+        // Resolve every level the manifest lists from the local cache,
+        // fetching only the ones whose hash is not cached yet. Returns
+        // false if levels are missing and fetchMissing is not set.
+        const entries = manifestEntries(manifest);
+        const values = await Promise.all(
+            entries.map(entry => this.levelCache.get(entry.hash)));
+        const missing = [];
+        values.forEach((value, i) => {
+            if (value === undefined) {
+                missing.push(i);
+            }
+        });
+        if (missing.length > 0 && !fetchMissing) {
+            return false;
+        }
+        if (missing.length > 0 && missing.length === entries.length) {
+            // Nothing cached yet: one request for everything
+            const info = manifest.bundle;
+            const bundle = await fetchBundle(`${info.url}?v=${info.hash}`);
+            if (bundle.version !== info.hash) {
+                // Content changed after the manifest was sent; play with
+                // it but do not file it under the manifest's hashes
+                this.applyLevels(bundle.charLevels, bundle.idiomLevels);
+                return true;
+            }
+            bundle.charLevels.concat(bundle.idiomLevels).forEach((value, i) => {
+                values[i] = value;
+            });
+            await this.levelCache.put(
+                entries.map((entry, i) => [entry.hash, values[i]]));
+        } else if (missing.length > 0) {
+            const fetched = await this.fetchLevels(
+                manifest, missing.map(i => entries[i]));
+            missing.forEach((i, j) => {
+                values[i] = fetched[j];
+            });
+            await this.levelCache.put(
+                missing.map((i, j) => [entries[i].hash, fetched[j]]));
+        }
+        const charCount = manifest.data.levels.count;
+        this.applyLevels(values.slice(0, charCount), values.slice(charCount));
+        return true;
+    }
+
+    async fetchLevels(manifest, entries) {
+        let syllables;
+        if (entries.some(entry => entry.kind === 'levels')) {
+            const table = manifest.syllables;
+            syllables = await this.levelCache.get(table.hash);
+            if (syllables === undefined) {
+                syllables = await fetchJSON(`${table.url}?v=${table.hash}`);
+                await this.levelCache.put([[table.hash, syllables]]);
             }
         }
-        console.log('Level data loading complete');
+        // Versioned URLs are cached by the browser as immutable
+        return Promise.all(entries.map(async entry => {
+            const data = await fetchJSON(`${entry.url}?v=${entry.hash}`);
+            return entry.kind === 'levels' ?
+                decodeCompactLevel(data, syllables) : data;
+        }));
+    }
+
+    applyLevels(charLevels, idiomLevels) {
+        this.charLevels = charLevels;
+        this.idiomLevels = idiomLevels;
+        this.levelCounts = {
+            levels: charLevels.length,
+            idioms: idiomLevels.length
+        };
+        this.setupLevelMenus();
+        console.log(`Loaded ${charLevels.length} character levels ` +
+            `and ${idiomLevels.length} idiom levels`);
+    }
+
+    levelCount(mode) {
+        return mode === Mode.IDIOM ?
+            this.levelCounts.idioms : this.levelCounts.levels;
     }
 
     initSpeech() {
@@ -936,9 +1148,12 @@ class Game {
     }
 
     setupLevelMenus() {
-        // Setup level menu for ROTATE mode (Levels 1-14)
+        // Menus are rebuilt whenever the level data (and so the level
+        // counts from the manifest) change
+        // Setup level menu for ROTATE mode
         const rotateMenu = document.getElementById('level-menu-rotate');
-        for (let i = 1; i <= 14; i++) {
+        rotateMenu.innerHTML = '';
+        for (let i = 1; i <= this.levelCount(Mode.ROTATE); i++) {
             const item = document.createElement('div');
             item.className = 'level-menu-item';
             item.textContent = `Level ${i}`;
@@ -951,9 +1166,10 @@ class Game {
             rotateMenu.appendChild(item);
         }
 
-        // Setup level menu for PINYIN mode (Levels 1-14)
+        // Setup level menu for PINYIN mode
         const pinyinMenu = document.getElementById('level-menu-pinyin');
-        for (let i = 1; i <= 14; i++) {
+        pinyinMenu.innerHTML = '';
+        for (let i = 1; i <= this.levelCount(Mode.PINYIN); i++) {
             const item = document.createElement('div');
             item.className = 'level-menu-item';
             item.textContent = `Level ${i}`;
@@ -966,9 +1182,10 @@ class Game {
             pinyinMenu.appendChild(item);
         }
 
-        // Setup level menu for IDIOM mode (Levels 1-6)
+        // Setup level menu for IDIOM mode
         const idiomMenu = document.getElementById('level-menu-idiom');
-        for (let i = 1; i <= 6; i++) {
+        idiomMenu.innerHTML = '';
+        for (let i = 1; i <= this.levelCount(Mode.IDIOM); i++) {
             const item = document.createElement('div');
             item.className = 'level-menu-item';
             item.textContent = `Level ${i}`;
@@ -1085,9 +1302,8 @@ class Game {
 
     setTargetRight() {
         if (this.mode === Mode.ROTATE || this.mode === Mode.PINYIN) {
-            const dataset = this.charLevels[this.level - 1] || {};
-            const n = Math.max(1,
-                Math.floor(Object.keys(dataset).length * 0.1));
+            const dataset = this.charLevels[this.level - 1] || EMPTY_CHAR_LEVEL;
+            const n = Math.max(1, Math.floor(dataset.chars.length * 0.1));
             this.targetRight = n;
         } else {
             const dataset = this.idiomLevels[this.level - 1] || [];
@@ -1097,12 +1313,7 @@ class Game {
     }
 
     nextLevel() {
-        let maxLevel;
-        if (this.mode === Mode.ROTATE || this.mode === Mode.PINYIN) {
-            maxLevel = 14;
-        } else {
-            maxLevel = 6;
-        }
+        const maxLevel = this.levelCount(this.mode);
         if (this.level < maxLevel) {
             this.level++;
             this.rightCount = 0;
@@ -1159,6 +1370,31 @@ class Game {
         this.updateScoreDisplay();
     }
 
+    pickCharIndex(dataset) {
+        // Pick a character not used yet on this level. Random probes are
+        // a direct index and succeed quickly while most are unused; the
+        // scan only runs near the end of a level.
+        const count = dataset.chars.length;
+        for (let tries = 0; tries < 8; tries++) {
+            const i = Math.floor(Math.random() * count);
+            if (!this.usedChars.has(dataset.chars[i])) {
+                return i;
+            }
+        }
+        const available = [];
+        for (let i = 0; i < count; i++) {
+            if (!this.usedChars.has(dataset.chars[i])) {
+                available.push(i);
+            }
+        }
+        if (available.length === 0) {
+            // All characters used, start over
+            this.usedChars.clear();
+            return Math.floor(Math.random() * count);
+        }
+        return available[Math.floor(Math.random() * available.length)];
+    }
+
     spawnRound() {
         this.currentBlocks = [];
         this.currentChar = null;
@@ -1179,27 +1415,17 @@ class Game {
                 this.showMessageUntil = Date.now() + 2000;
                 return;
             }
-            const dataset = this.charLevels[this.level - 1] || {};
-            if (Object.keys(dataset).length === 0) {
+            const dataset = this.charLevels[this.level - 1] || EMPTY_CHAR_LEVEL;
+            if (dataset.chars.length === 0) {
                 this.message = 'No characters available for this level.\n' +
                     'Please add level data files.';
                 this.showMessageUntil = Date.now() + 3000;
                 console.warn(`Level ${this.level} data is empty`);
                 return;
             }
-            let available = {};
-            for (const [ch, py] of Object.entries(dataset)) {
-                if (!this.usedChars.has(ch)) {
-                    available[ch] = py;
-                }
-            }
-            if (Object.keys(available).length === 0) {
-                this.usedChars.clear();
-                available = dataset;
-            }
-            const entries = Object.entries(available);
-            const [ch, py] = entries[
-                Math.floor(Math.random() * entries.length)];
+            const index = this.pickCharIndex(dataset);
+            const ch = dataset.chars[index];
+            const py = dataset.pinyin[index];
             let angle = 0;
             if (this.mode === Mode.ROTATE) {
                 angle = [90, 180, 270][
@@ -1965,5 +2191,11 @@ class Game {
 // Initialize game when page loads
 window.addEventListener('load', () => {
     new Game();
+    // Cache the game for instant and offline loads after the first visit
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/sw.js').catch(e => {
+            console.warn('Service worker registration failed:', e);
+        });
+    }
 });
 
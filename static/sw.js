@@ -0,0 +1,97 @@
+// Service worker: serves the game shell and level data cache-first so the
+// game loads instantly and keeps working offline after the first visit;
+// the level manifest is fetched network-first, falling back to the cache.
+// self.PRECACHE ({version, urls}) is prepended by the /sw.js route in
+// app.py; a new level manifest or shell file changes this script, which
+// makes the browser install the new version in the background.
+const CACHE_PREFIX = 'ccb-';
+const CACHE_NAME = CACHE_PREFIX + self.PRECACHE.version;
+// Fingerprinted shell files, e.g. /game.3f9c2a71b0de.js
+const FINGERPRINTED = /\.[0-9a-f]{12}\.(js|css)$/;
+// Fetched from the network first and served from the cache only when
+// offline: the game compares the manifest against its IndexedDB copy to
+// find changed levels, so a cached manifest would hide updates until the
+// next page load
+const NETWORK_FIRST = new Set(['/api/manifest']);
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => cache.addAll(self.PRECACHE.urls))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    // Drop caches of older versions once this one is in charge
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names
+                .filter(name => name.startsWith(CACHE_PREFIX) &&
+                    name !== CACHE_NAME)
+                .map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    // Range requests (video seeking) and anything that is not a plain
+    // same-origin GET go straight to the network
+    if (request.method !== 'GET' || request.headers.has('range')) {
+        return;
+    }
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin || url.pathname === '/sw.js') {
+        return;
+    }
+    event.respondWith(respond(event, request, url));
+});
+
+async function respond(event, request, url) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request);
+    // Versioned URLs (?v=<hash> or a hashed name) never change, so a hit
+    // is final
+    if (cached && (url.searchParams.has('v') ||
+            FINGERPRINTED.test(url.pathname))) {
+        return cached;
+    }
+    if (NETWORK_FIRST.has(url.pathname)) {
+        try {
+            const response = await fetch(request);
+            if (response.ok) {
+                cache.put(request, response.clone());
+            }
+            return response;
+        } catch (e) {
+            if (cached) {
+                return cached;
+            }
+            throw e;
+        }
+    }
+    const update = fetch(request).then(response => {
+        if (response.ok) {
+            cache.put(request, response.clone());
+        }
+        return response;
+    });
+    if (cached) {
+        // Serve the cached copy now and refresh it in the background
+        event.waitUntil(update.catch(() => {}));
+        return cached;
+    }
+    try {
+        return await update;
+    } catch (e) {
+        // Offline: any page of the single-page app is the cached shell
+        if (request.mode === 'navigate') {
+            const shell = await cache.match('/');
+            if (shell) {
+                return shell;
+            }
+        }
+        throw e;
+    }
+}
@@ -0,0 +1,254 @@
+import os
+import re
+
+from metrics import CACHE_LOOKUPS, phase
+from payloads import Payload
+from polling import Poller
+from singleflight import SingleFlight
+
+# Content types of the files the catch-all route may serve, by extension
+STATIC_TYPES = {
+    '.js': 'application/javascript',
+    '.css': 'text/css',
+    '.html': 'text/html',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.svg': 'image/svg+xml',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.ttf': 'font/ttf',
+    '.eot': 'application/vnd.ms-fontobject',
+    '.wav': 'audio/wav',
+    '.json': 'application/json',
+}
+
+# Files up to this size are kept in memory as payloads; larger ones are
+# streamed from disk
+MAX_CACHED_SIZE = 1024 * 1024
+
+# Files that pages reference by a content-hashed name such as
+# game.3f9c2a71b0de.js. Hashed URLs can be cached forever; only the page
+# that points at them has to be revalidated.
+FINGERPRINTED = ('game.js', 'style.css')
+
+FINGERPRINT_LENGTH = 12
+
+_REFERENCE = re.compile(r'((?:src|href)=")([^"]+)(")')
+
+
+def fingerprinted_name(filename, payload):
+    """Return filename with the first hex digits of its hash inserted."""
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}.{payload.version[:FINGERPRINT_LENGTH]}{ext}'
+
+
+class StaticEntry(object):
+    """A servable file: where it is, what it is and, if small, its body.
+
+    loaded is False for a small file whose body has not been read yet.
+    """
+
+    __slots__ = ('path', 'mimetype', 'size', 'mtime', 'payload', 'loaded')
+
+    def __init__(self, path, mimetype, size, mtime, payload=None,
+                 loaded=True):
+        self.path = path
+        self.mimetype = mimetype
+        self.size = size
+        self.mtime = mtime
+        self.payload = payload
+        self.loaded = loaded
+
+
+def _load_entry(path, mimetype, read=True):
+    """Stat (and read, if small) a file; return None if it is missing.
+
+    With read False, a small file is only stat'ed, and its entry is
+    marked as not loaded.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    payload = None
+    if stat.st_size <= MAX_CACHED_SIZE:
+        if not read:
+            return StaticEntry(path, mimetype, stat.st_size, stat.st_mtime,
+                               loaded=False)
+        with open(path, 'rb') as f:
+            payload = Payload(f.read(), mimetype,
+                              last_modified=stat.st_mtime)
+    return StaticEntry(path, mimetype, stat.st_size, stat.st_mtime, payload)
+
+
+class StaticFiles(object):
+    """Table of servable static files, keyed by URL path.
+
+    The table is built from directory (recursively) and, for extra_types,
+    the top level of extra_directory, once at startup. Lookups are a dict
+    lookup with no filesystem access; small files carry their bytes as
+    pre-encoded payloads. refresh() rescans the directories, and watch()
+    does so every few seconds in a background thread, so edits, new and
+    removed files show up without a restart. With auto_reload set, each
+    lookup re-stats the file instead, so edits show up at once (used by
+    the development server). With lazy set, the scan only stats files
+    and each small file is read on its first lookup (used in cold-start
+    mode, where most files are never requested).
+    """
+
+    def __init__(self, directory, extra_directory=None, extra_types=(),
+                 auto_reload=False, lazy=False):
+        self.directory = directory
+        self.extra_directory = extra_directory
+        self.extra_types = frozenset(extra_types)
+        self.auto_reload = auto_reload
+        self.lazy = lazy
+        self._reads = SingleFlight('static')
+        self._table = {}
+        self._pages = {}
+        self._poller = Poller(self.refresh, 'static-reload',
+                              'Static file rescan failed; keeping the '
+                              'current file table')
+        self.refresh()
+
+    def _candidates(self):
+        """Yield (url path, file path, mimetype) for every servable file."""
+        if self.extra_directory is not None and os.path.isdir(
+                self.extra_directory):
+            for name in sorted(os.listdir(self.extra_directory)):
+                ext = os.path.splitext(name)[1].lower()
+                if ext in self.extra_types:
+                    yield (name, os.path.join(self.extra_directory, name),
+                           STATIC_TYPES[ext])
+        # Files in the static directory win over same-named extra files
+        for root, _, files in os.walk(self.directory):
+            for name in sorted(files):
+                ext = os.path.splitext(name)[1].lower()
+                if ext not in STATIC_TYPES:
+                    continue
+                path = os.path.join(root, name)
+                url = os.path.relpath(path, self.directory)
+                yield url.replace(os.sep, '/'), path, STATIC_TYPES[ext]
+
+    def refresh(self):
+        """Rescan the directories, reusing entries whose files are unchanged.
+
+        The new table replaces the old one in a single assignment, so
+        concurrent lookups see either table, never a partial one.
+        """
+        table = {}
+        for url, path, mimetype in self._candidates():
+            entry = self._table.get(url)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (entry is None or entry.path != path or
+                    entry.mtime != stat.st_mtime or
+                    entry.size != stat.st_size):
+                entry = _load_entry(path, mimetype, read=not self.lazy)
+            if entry is not None:
+                table[url] = entry
+        self._table = table
+
+    def watch(self, interval):
+        """Rescan every interval seconds, in a daemon thread."""
+        self._poller.start(interval)
+
+    def stop(self):
+        """Stop rescanning in this process; forked children still do."""
+        self._poller.stop()
+
+    def lookup(self, filename):
+        """Return the StaticEntry for a URL path, or None."""
+        with phase('lookup'):
+            entry = self._table.get(filename)
+            CACHE_LOOKUPS.inc('static', 'miss' if entry is None else 'hit')
+            if entry is not None and not entry.loaded:
+                with phase('load'):
+                    entry = self._reads.do(
+                        filename, lambda: self._read(filename, entry))
+            if not self.auto_reload:
+                return entry
+            with phase('load'):
+                return self._reload(filename, entry)
+
+    def _read(self, filename, entry):
+        """Read the body of a lazily indexed file into the table."""
+        current = self._table.get(filename)
+        if current is not None and current.loaded:
+            return current
+        loaded = _load_entry(entry.path, entry.mimetype)
+        if loaded is None:
+            self._table.pop(filename, None)
+        else:
+            self._table[filename] = loaded
+        return loaded
+
+    def _reload(self, filename, entry):
+        """Re-stat a looked-up file, reloading or dropping it if changed."""
+        if entry is None:
+            # New files show up on the next rescan
+            self.refresh()
+            return self._table.get(filename)
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            self._table.pop(filename, None)
+            return None
+        if entry.mtime != stat.st_mtime or entry.size != stat.st_size:
+            entry = _load_entry(entry.path, entry.mimetype)
+            if entry is None:
+                self._table.pop(filename, None)
+            else:
+                self._table[filename] = entry
+        return entry
+
+    def urls(self):
+        """Return the URL paths in the file table."""
+        return list(self._table)
+
+    def get(self, filename):
+        """Return the payload of a cached file, or None."""
+        entry = self.lookup(filename)
+        return entry.payload if entry is not None else None
+
+    def fingerprinted(self, filename):
+        """Return the hashed name of a FINGERPRINTED file, or None."""
+        payload = self.get(filename)
+        if payload is None:
+            return None
+        return fingerprinted_name(filename, payload)
+
+    def page(self, filename):
+        """Return an HTML page whose FINGERPRINTED references are hashed.
+
+        The rewritten page is cached until the page or one of the files
+        it references changes.
+        """
+        source = self.get(filename)
+        if source is None:
+            return None
+        names = {name: self.fingerprinted(name) for name in FINGERPRINTED}
+        key = (source.version,) + tuple(sorted(filter(None, names.values())))
+        cached = self._pages.get(filename)
+        if cached is not None and cached[0] == key:
+            CACHE_LOOKUPS.inc('pages', 'hit')
+            return cached[1]
+        CACHE_LOOKUPS.inc('pages', 'miss')
+
+        def rewrite(match):
+            hashed = names.get(match.group(2))
+            if hashed is None:
+                return match.group(0)
+            return match.group(1) + hashed + match.group(3)
+
+        html = _REFERENCE.sub(rewrite, source.body.decode('utf-8'))
+        payload = Payload(html.encode('utf-8'), 'text/html',
+                          last_modified=source.last_modified)
+        self._pages[filename] = (key, payload)
+        return payload
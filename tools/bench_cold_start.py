@@ -0,0 +1,110 @@
+"""Measure cold-start time: process spawn to the first 200 on /api/levels/1.
+
+Each run starts a fresh Python process that imports app.py and answers
+GET /api/levels/1, the way a serverless instance handles its first
+request, and times it from spawn to the response. Runs are repeated
+with cold-start mode off and on (CCB_COLD_START) and summarized.
+
+    python tools/bench_cold_start.py
+    python tools/bench_cold_start.py --runs 20 --http
+
+With --http the process is a real server (python app.py serve) polled
+over HTTP until it answers, which includes binding and preloading.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+URL = '/api/levels/1'
+
+# Imports the app and calls it once through WSGI, like a serverless handler
+HANDLER = f'''
+import json, sys
+import app
+from werkzeug.test import EnvironBuilder
+statuses = []
+environ = EnvironBuilder({URL!r}).get_environ()
+body = b''.join(app.app(environ, lambda status, headers: statuses.append(status)))
+print(statuses[0].split()[0], json.dumps(app.BOOT_TIMING), flush=True)
+'''
+
+
+def run_handler(env):
+    """Return (seconds from spawn to first 200, boot report)."""
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', HANDLER], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, check=True).stdout
+    elapsed = time.perf_counter() - started
+    status, boot = output.decode('utf-8').strip().split(' ', 1)
+    if status != '200':
+        raise RuntimeError(f'{URL} returned {status}')
+    return elapsed, json.loads(boot)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_http(env):
+    """Return (seconds from spawn to first 200 over HTTP, None)."""
+    port = _free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, 'app.py', 'serve', '--workers', '1',
+         '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(
+                        f'http://127.0.0.1:{port}{URL}', timeout=5) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - started, None
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError('server exited before answering')
+                time.sleep(0.005)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='processes to start per mode (default: 10)')
+    parser.add_argument('--http', action='store_true',
+                        help='time a real server over HTTP instead')
+    args = parser.parse_args(argv)
+
+    run = run_http if args.http else run_handler
+    for cold_start in ('0', '1'):
+        env = dict(os.environ, CCB_COLD_START=cold_start)
+        env.pop('VERCEL', None)
+        timings = []
+        boot = None
+        for _ in range(args.runs):
+            elapsed, boot = run(env)
+            timings.append(elapsed * 1000)
+        label = 'cold-start mode' if cold_start == '1' else 'default mode'
+        print(f'{label:16} median {statistics.median(timings):7.1f} ms  '
+              f'min {min(timings):7.1f} ms  max {max(timings):7.1f} ms')
+        if boot:
+            print(f'{"":16} import {boot["import_ms"]} ms, boot '
+                  f'{boot["boot_ms"]} ms, level data {boot["level_data"]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""Benchmark the app's routes and compare against committed baselines.
+
+Each route is measured two ways:
+
+    client  the Flask test client, in-process: the cost of the app itself
+    server  a real local server (python app.py serve) over HTTP from
+            concurrent clients: adds the WSGI server and the network
+            stack, including a TCP connection per request, since the
+            server closes each connection after one response
+
+and reported as throughput (requests/second) and p50/p95/p99 latency.
+Each route is measured --runs times (default 3) and every figure is the
+median across runs, so one disturbed run does not skew the result.
+
+    python tools/bench_endpoints.py                     # print results
+    python tools/bench_endpoints.py --save              # update baseline
+    python tools/bench_endpoints.py --compare           # fail on regression
+    python tools/bench_endpoints.py --compare --threshold 0.25
+
+--compare fails (exit code 1) if any route's p50 or p95 latency, or its
+time per request (the inverse of throughput), is more than --threshold
+(a fraction, default 0.20) above the baseline. Changes smaller than
+--min-delta-ms are ignored, so sub-millisecond noise does not count.
+Baselines depend on the machine, so refresh them with --save on the
+machine you compare on.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# No access log, here or in the server started below: it would interleave
+# with the results and its cost would be timed along with each request
+os.environ['CCB_LOG_SAMPLE'] = '0'
+
+import app  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, 'tools', 'baselines', 'endpoints.json')
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+# Latency and throughput fields compared against the baseline, and
+# whether higher values are better
+COMPARED = [('p50_ms', False), ('p95_ms', False), ('rps', True)]
+
+FIELDS = ('requests', 'rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def routes():
+    """Return the (name, url, headers) routes to benchmark."""
+    result = [
+        ('index', '/', GZIP),
+        ('game.js', '/game.js', GZIP),
+        ('spa-fallback', '/some/deep/link', GZIP),
+        ('fireworks.wav', '/assets/fireworks.wav', {}),
+    ]
+    for n in app.level_registry.level_numbers(app.CHAR_LEVELS):
+        result.append((f'levels/{n}', f'/api/levels/{n}', GZIP))
+    for n in app.level_registry.level_numbers(app.IDIOM_LEVELS):
+        result.append((f'idioms/{n}', f'/api/idioms/{n}', GZIP))
+    return result
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def median_stats(runs):
+    """Return the median of each field over several summarize() results."""
+    return {field: round(statistics.median(stats[field] for stats in runs), 3)
+            for field in FIELDS}
+
+
+def bench_client(url, headers, requests):
+    client = app.app.test_client()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        t = time.perf_counter()
+        response = client.get(url, headers=headers)
+        response.get_data()
+        latencies.append(time.perf_counter() - t)
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} returned {response.status_code}')
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def bench_server(port, url, headers, requests, connections):
+    """Spread requests over concurrent clients, one thread each.
+
+    http.client reconnects after every response, as the server sends
+    Connection: close.
+    """
+    latencies = []
+    errors = []
+    per_connection = max(1, requests // connections)
+
+    def run():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        mine = []
+        try:
+            for _ in range(per_connection):
+                t = time.perf_counter()
+                conn.request('GET', url, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                mine.append(time.perf_counter() - t)
+                if response.status != 200:
+                    errors.append(response.status)
+        except OSError as e:
+            errors.append(e)
+        finally:
+            conn.close()
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=run) for _ in range(connections)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if errors:
+        raise RuntimeError(f'{url}: {len(errors)} errors, e.g. {errors[0]}')
+    return summarize(latencies, elapsed)
+
+
+def start_server(workers, threads):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, 'app.py', 'serve', '--port', str(port),
+         '--workers', str(workers), '--threads', str(threads)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('benchmark server did not start')
+
+
+def run(args):
+    results = {'client': {}, 'server': {}}
+    app.preload()
+    for name, url, headers in routes():
+        # Warm up, so first-use costs do not skew the percentiles
+        bench_client(url, headers, 10)
+        results['client'][name] = median_stats(
+            [bench_client(url, headers, args.requests)
+             for _ in range(args.runs)])
+        print(f'client  {name:16} {_format(results["client"][name])}')
+    if not args.client_only:
+        process, port = start_server(args.workers, args.threads)
+        try:
+            for name, url, headers in routes():
+                bench_server(port, url, headers, args.connections * 5,
+                             args.connections)
+                results['server'][name] = median_stats(
+                    [bench_server(port, url, headers, args.requests,
+                                  args.connections)
+                     for _ in range(args.runs)])
+                print(f'server  {name:16} '
+                      f'{_format(results["server"][name])}')
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def _format(stats):
+    return (f'{stats["rps"]:9.1f} req/s  p50 {stats["p50_ms"]:7.3f} ms  '
+            f'p95 {stats["p95_ms"]:7.3f} ms  p99 {stats["p99_ms"]:7.3f} ms')
+
+
+def compare(results, baseline, threshold, min_delta_ms=0.0):
+    """Return the regressions of results against baseline, as messages."""
+    regressions = []
+    for mode, routes_stats in results.items():
+        for name, stats in routes_stats.items():
+            base = baseline.get('results', {}).get(mode, {}).get(name)
+            if base is None:
+                continue
+            for field, higher_is_better in COMPARED:
+                value, base_value = stats[field], base[field]
+                if higher_is_better:
+                    # Throughput is compared as milliseconds per request,
+                    # so the same noise floor applies to it
+                    value, base_value = 1000 / value, 1000 / base_value
+                if value > base_value + max(base_value * threshold,
+                                            min_delta_ms):
+                    regressions.append(
+                        f'{mode} {name} {field}: {stats[field]} vs '
+                        f'baseline {base[field]}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route and mode (default: 500)')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='runs per route and mode; figures are the '
+                             'median (default: 3)')
+    parser.add_argument('--connections', type=int, default=8,
+                        help='concurrent connections to the server')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='server worker processes (default: 2)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='server threads per worker (default: 8)')
+    parser.add_argument('--client-only', action='store_true',
+                        help='skip the real server')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='write the results as the new baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='fail if results regress against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.20,
+                        help='allowed regression, as a fraction')
+    parser.add_argument('--min-delta-ms', type=float, default=0.25,
+                        help='ignore latency and time-per-request changes '
+                             'below this many ms')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'machine': {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'cpus': os.cpu_count()},
+                'settings': {'requests': args.requests,
+                             'runs': args.runs,
+                             'connections': args.connections,
+                             'workers': args.workers,
+                             'threads': args.threads},
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Wrote {args.baseline}')
+    if args.compare:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold,
+                              args.min_delta_ms)
+        for message in regressions:
+            print(f'REGRESSION {message}')
+        print(f'{len(regressions)} regressions above '
+              f'{args.threshold:.0%} of the baseline')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
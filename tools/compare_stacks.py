@@ -0,0 +1,206 @@
+"""Run the Flask app and the ASGI app against the same requests.
+
+Every fixture request is sent to both stacks in-process (the Flask test
+client and a direct ASGI call), then again as a conditional request with
+the ETag of the first response. Status, body and the caching headers must
+match; any difference is printed and the exit code is 1.
+
+    python tools/compare_stacks.py
+    python tools/compare_stacks.py --concurrency 2000
+
+--concurrency also runs that many concurrent page bootstraps (shell,
+manifest and level bundle) through the ASGI app in one event loop and
+reports how long they took.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as wsgi  # noqa: E402
+import asgi  # noqa: E402
+
+# Headers that must be identical between the two stacks
+COMPARED_HEADERS = [
+    'Content-Type', 'Content-Encoding', 'Content-Length', 'Content-Range',
+    'ETag', 'Cache-Control', 'Last-Modified', 'Vary', 'Accept-Ranges',
+    'Service-Worker-Allowed', 'Access-Control-Allow-Origin',
+    'Access-Control-Allow-Methods', 'Access-Control-Max-Age', 'Allow',
+]
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+PREFLIGHT = {'Origin': 'https://portal.example.edu',
+             'Access-Control-Request-Method': 'GET'}
+
+
+def fixtures():
+    """Return the (method, url, headers) requests both stacks must answer."""
+    game_js = wsgi.static_files.fingerprinted('game.js')
+    manifest = json.loads(bytes(wsgi.level_registry.manifest().body))
+    bundle = f'{manifest["bundle"]["url"]}?v={manifest["bundle"]["hash"]}'
+    requests = [
+        ('GET', '/', {}),
+        ('GET', '/', GZIP),
+        ('GET', '/index.html', {}),
+        ('GET', '/game.js', GZIP),
+        ('GET', '/style.css', {}),
+        ('GET', f'/{game_js}', GZIP),
+        ('GET', '/game.000000000000.js', {}),
+        ('GET', '/sw.js', {}),
+        ('GET', '/api/manifest', GZIP),
+        ('GET', bundle, GZIP),
+        ('GET', '/api/bundle', {}),
+        ('GET', '/api/v2/syllables', {}),
+        ('GET', '/api/v2/levels/2', GZIP),
+        ('GET', '/api/v2/levels/999', {}),
+        ('GET', '/api/idioms/3', {}),
+        ('GET', '/api/unknown', {}),
+        ('GET', '/level1.json', {}),
+        ('GET', '/some/spa/route', {}),
+        ('GET', '/health/live', {}),
+        ('GET', '/health/ready', {}),
+        ('GET', '/assets/fireworks.wav', {'Range': 'bytes=0-99'}),
+        ('GET', '/assets/fireworks.wav', {'Range': 'bytes=-10'}),
+        ('GET', '/assets/missing.mp4', {}),
+        ('HEAD', '/api/levels/1', {}),
+        ('OPTIONS', '/api/levels/1', PREFLIGHT),
+        ('OPTIONS', '/', PREFLIGHT),
+        ('OPTIONS', '/api/manifest', {}),
+        ('GET', '/api/manifest', {'Origin': 'https://portal.example.edu'}),
+    ]
+    for n in wsgi.level_registry.level_numbers(wsgi.CHAR_LEVELS):
+        requests.append(('GET', f'/api/levels/{n}', GZIP))
+    return requests
+
+
+def call_wsgi(client, method, url, headers):
+    response = client.open(url, method=method, headers=headers)
+    return response.status_code, response.headers, response.get_data()
+
+
+async def call_asgi(method, url, headers):
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query.encode('latin-1'),
+        'headers': [(name.lower().encode('latin-1'),
+                     value.encode('latin-1'))
+                    for name, value in headers.items()],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.app(scope, receive, send)
+    start = messages[0]
+    response_headers = {}
+    for name, value in start['headers']:
+        response_headers[name.decode('latin-1')] = value.decode('latin-1')
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], _Headers(response_headers), body
+
+
+class _Headers(dict):
+    """Case-insensitive get() over lowercased header names."""
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+
+def differences(wsgi_reply, asgi_reply):
+    """Return the ways two (status, headers, body) replies differ."""
+    problems = []
+    if wsgi_reply[0] != asgi_reply[0]:
+        problems.append(f'status {wsgi_reply[0]} != {asgi_reply[0]}')
+    for name in COMPARED_HEADERS:
+        a, b = wsgi_reply[1].get(name), asgi_reply[1].get(name)
+        if a != b:
+            problems.append(f'{name}: {a!r} != {b!r}')
+    if wsgi_reply[2] != asgi_reply[2]:
+        # JSON built per request (health) may differ in key order only
+        try:
+            same = json.loads(wsgi_reply[2]) == json.loads(asgi_reply[2])
+        except ValueError:
+            same = False
+        if not same:
+            problems.append(f'body differs ({len(wsgi_reply[2])} vs '
+                            f'{len(asgi_reply[2])} bytes)')
+        elif 'Content-Length' in COMPARED_HEADERS:
+            problems = [p for p in problems
+                        if not p.startswith('Content-Length')]
+    return problems
+
+
+def compare(loop):
+    client = wsgi.app.test_client()
+    failures = 0
+    count = 0
+    for method, url, headers in fixtures():
+        first = call_wsgi(client, method, url, headers)
+        variants = [headers]
+        etag = first[1].get('ETag')
+        if etag:
+            variants.append(dict(headers, **{'If-None-Match': etag}))
+        for request_headers in variants:
+            wsgi_reply = call_wsgi(client, method, url, request_headers)
+            asgi_reply = loop.run_until_complete(
+                call_asgi(method, url, request_headers))
+            count += 1
+            problems = differences(wsgi_reply, asgi_reply)
+            if problems:
+                failures += 1
+                print(f'MISMATCH {method} {url} {request_headers}')
+                for problem in problems:
+                    print(f'    {problem}')
+    print(f'{count - failures}/{count} requests matched')
+    return failures
+
+
+async def bootstrap():
+    """One page load: the shell, then the manifest and level bundle."""
+    for url in ('/', '/api/manifest', '/api/v2/bundle'):
+        status, _, _ = await call_asgi('GET', url, GZIP)
+        if status != 200:
+            raise RuntimeError(f'{url} returned {status}')
+
+
+def load(loop, concurrency):
+    async def run():
+        started = time.perf_counter()
+        await asyncio.gather(*[bootstrap() for _ in range(concurrency)])
+        return time.perf_counter() - started
+    elapsed = loop.run_until_complete(run())
+    print(f'{concurrency} concurrent bootstraps ({concurrency * 3} requests) '
+          f'in {elapsed * 1000:.0f} ms through the ASGI app')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='also run this many concurrent bootstraps')
+    args = parser.parse_args(argv)
+
+    wsgi.preload()
+    loop = asyncio.new_event_loop()
+    try:
+        failures = compare(loop)
+        if args.concurrency:
+            load(loop, args.concurrency)
+    finally:
+        loop.close()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
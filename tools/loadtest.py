@@ -0,0 +1,329 @@
+"""Load-test a running server with simulated classrooms of players.
+
+Each virtual player behaves like a browser opening the game:
+
+    page       GET / and the script and stylesheet it references
+    bootstrap  GET /api/manifest, then the level bundle it names (what
+               loadLevelData does today); with --bootstrap legacy, the
+               old 20-request sequence /api/levels/1..14, /api/idioms/1..6
+    gameplay   while playing, a conditional GET of a level every
+               --think seconds (the service worker revalidating cached
+               levels), answered with 304s
+
+Players start linearly over --ramp seconds and play until --duration
+seconds have passed since the start. Only the standard library is used.
+Each player has one HTTP/1.1 client connection, kept open only while the
+server allows it: python app.py serve answers with Connection: close, so
+there every request opens a new TCP connection, and the latencies
+include connecting.
+
+    python app.py serve --workers 4 &
+    python tools/loadtest.py --players 200 --ramp 20 --duration 60
+
+    python tools/loadtest.py --serve --workers 2 --players 40
+
+The report has a latency histogram and p50/p95/p99 per request kind,
+error rates, and the time from a player's first request until the game
+was playable (page and bootstrap done).
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LEGACY_BOOTSTRAP = ([f'/api/levels/{n}' for n in range(1, 15)] +
+                    [f'/api/idioms/{n}' for n in range(1, 7)])
+
+_SHELL_REFERENCE = re.compile(rb'(?:src|href)="([^"]+\.(?:js|css))"')
+
+# Histogram bucket upper bounds, in milliseconds
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+              float('inf')]
+
+
+class HTTPError(Exception):
+    """Raised for responses that are neither 2xx nor 304."""
+
+
+class Connection(object):
+    """A minimal HTTP/1.1 client connection.
+
+    It reconnects after a response with Connection: close (every response
+    from python app.py serve) and reuses the connection otherwise.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def get(self, path, headers=None):
+        """Return (status, headers, body), reconnecting if needed."""
+        for attempt in (1, 2):
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection(
+                    self.host, self.port)
+            try:
+                return await self._request(path, headers or {})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The server closed the connection without saying so;
+                # retry once on a fresh one
+                self.close()
+                if attempt == 2:
+                    raise
+
+    async def _request(self, path, headers):
+        lines = [f'GET {path} HTTP/1.1', f'Host: {self.host}:{self.port}',
+                 'Accept-Encoding: gzip']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await self._writer.drain()
+
+        status_line = await self._reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self._reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                line = await self._reader.readuntil(b'\r\n')
+                size = int(line.split(b';')[0], 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        else:
+            length = int(response_headers.get('content-length', 0))
+            body = await self._reader.readexactly(length) if length else b''
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, response_headers, body
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class Stats(object):
+    """Latencies and errors per request kind."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.playable = []
+
+    def record(self, kind, seconds):
+        self.latencies.setdefault(kind, []).append(seconds * 1000)
+
+    def error(self, kind, message):
+        self.errors.setdefault(kind, {}).setdefault(message, 0)
+        self.errors[kind][message] += 1
+
+
+async def timed(stats, kind, connection, path, headers=None):
+    """Send one request, recording its latency or its error."""
+    started = time.perf_counter()
+    try:
+        status, response_headers, body = await connection.get(path, headers)
+        if not (200 <= status < 300 or status == 304):
+            raise HTTPError(f'HTTP {status}')
+    except (OSError, asyncio.IncompleteReadError, HTTPError) as e:
+        stats.error(kind, str(e) or type(e).__name__)
+        return None
+    stats.record(kind, time.perf_counter() - started)
+    return status, response_headers, body
+
+
+async def player(args, stats, deadline):
+    """One virtual player: load the page, bootstrap, then play."""
+    connection = Connection(args.host, args.port)
+    started = time.perf_counter()
+    try:
+        page = await timed(stats, 'page', connection, '/')
+        if page is None:
+            return
+        for path in _SHELL_REFERENCE.findall(_decode(page)):
+            await timed(stats, 'page', connection,
+                        '/' + path.decode('latin-1').lstrip('/'))
+
+        etags = {}
+        if args.bootstrap == 'legacy':
+            paths = LEGACY_BOOTSTRAP
+        else:
+            reply = await timed(stats, 'bootstrap', connection,
+                                '/api/manifest')
+            if reply is None:
+                return
+            manifest = json.loads(_decode(reply))
+            bundle = manifest['bundle']
+            paths = [f'{bundle["url"]}?v={bundle["hash"]}']
+            for entries in manifest['data'].values():
+                for entry in entries['entries']:
+                    etags[entry['url']] = f'"{entry["hash"]}-gzip"'
+        for path in paths:
+            reply = await timed(stats, 'bootstrap', connection, path)
+            if reply is not None and 'etag' in reply[1]:
+                etags[path] = reply[1]['etag']
+        stats.playable.append((time.perf_counter() - started) * 1000)
+
+        revalidate = sorted(etags.items())
+        while revalidate and time.monotonic() < deadline:
+            await asyncio.sleep(args.think * random.uniform(0.5, 1.5))
+            path, etag = random.choice(revalidate)
+            await timed(stats, 'gameplay', connection, path,
+                        {'If-None-Match': etag})
+    finally:
+        connection.close()
+
+
+def _decode(reply):
+    _, headers, body = reply
+    if headers.get('content-encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return body
+
+
+async def run(args):
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + args.duration
+    tasks = []
+    for i in range(args.players):
+        # Linear ramp: player i starts at i/players of the ramp time
+        delay = started + args.ramp * i / args.players - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(player(args, stats, deadline)))
+    await asyncio.gather(*tasks)
+    return stats, time.monotonic() - started
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def histogram(values):
+    counts = [0] * len(BUCKETS_MS)
+    for value in values:
+        for i, bound in enumerate(BUCKETS_MS):
+            if value <= bound:
+                counts[i] += 1
+                break
+    widest = max(counts) or 1
+    lines = []
+    lower = 0
+    for bound, count in zip(BUCKETS_MS, counts):
+        if count:
+            label = f'{lower:g}-{bound:g} ms' if bound != float('inf') \
+                else f'>{lower:g} ms'
+            lines.append(f'    {label:>14} {count:7d} '
+                         f'{"#" * max(1, 40 * count // widest)}')
+        lower = bound
+    return lines
+
+
+def report(stats, elapsed):
+    total = sum(len(values) for values in stats.latencies.values())
+    failed = sum(sum(errors.values()) for errors in stats.errors.values())
+    print(f'{total + failed} requests in {elapsed:.1f} s '
+          f'({(total + failed) / elapsed:.1f} req/s), '
+          f'{failed} errors ({failed / max(1, total + failed):.2%})')
+    for kind in ('page', 'bootstrap', 'gameplay'):
+        values = sorted(stats.latencies.get(kind, []))
+        errors = stats.errors.get(kind, {})
+        count = len(values) + sum(errors.values())
+        if not count:
+            continue
+        print(f'\n{kind}: {count} requests, '
+              f'{sum(errors.values()) / count:.2%} errors')
+        if values:
+            print(f'    p50 {percentile(values, 0.5):.1f} ms  '
+                  f'p95 {percentile(values, 0.95):.1f} ms  '
+                  f'p99 {percentile(values, 0.99):.1f} ms  '
+                  f'max {values[-1]:.1f} ms')
+            print('\n'.join(histogram(values)))
+        for message, n in sorted(errors.items()):
+            print(f'    error: {message} x{n}')
+    if stats.playable:
+        values = sorted(stats.playable)
+        print(f'\ntime to playable: {len(values)} players, '
+              f'p50 {percentile(values, 0.5):.1f} ms  '
+              f'p95 {percentile(values, 0.95):.1f} ms  '
+              f'p99 {percentile(values, 0.99):.1f} ms')
+
+
+def start_server(port, workers):
+    process = subprocess.Popen(
+        [sys.executable, 'app.py', 'serve', '--port', str(port),
+         '--workers', str(workers)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000',
+                        help='server to test (default: %(default)s)')
+    parser.add_argument('--players', type=int, default=40,
+                        help='virtual players (default: a class of 40)')
+    parser.add_argument('--ramp', type=float, default=10,
+                        help='seconds over which players join (default: 10)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds the test runs (default: 30)')
+    parser.add_argument('--think', type=float, default=2,
+                        help='mean seconds between gameplay requests')
+    parser.add_argument('--bootstrap', choices=['manifest', 'legacy'],
+                        default='manifest',
+                        help='level loading sequence to replay')
+    parser.add_argument('--serve', action='store_true',
+                        help='start python app.py serve on --url first')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='workers for --serve (default: 2)')
+    args = parser.parse_args(argv)
+
+    url = urlsplit(args.url)
+    args.host, args.port = url.hostname, url.port or 80
+    process = start_server(args.port, args.workers) if args.serve else None
+    try:
+        stats, elapsed = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    report(stats, elapsed)
+    failed = sum(sum(errors.values()) for errors in stats.errors.values())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())